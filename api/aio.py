@@ -0,0 +1,76 @@
+import asyncio
+
+from api.macrostrat import fetch_map_polygons, fetch_units
+from api.paleobiodb import PAGE_SIZE, fetch_occurrences
+from api.tiling import (fetch_map_polygons_tiled, fetch_occurrences_tiled, fetch_units_tiled,
+                        get_tile_cache)
+
+
+async def fetch_units_async(bbox, interval_name=None, age_top=None, age_bottom=None):
+    return await asyncio.to_thread(fetch_units, bbox, interval_name=interval_name,
+                                   age_top=age_top, age_bottom=age_bottom)
+
+
+async def fetch_occurrences_async(bbox, taxa=None, interval=None, age_top=None, age_bottom=None,
+                                  page_size=None, on_page=None):
+    return await asyncio.to_thread(fetch_occurrences, bbox, taxa=taxa, interval=interval,
+                                   age_top=age_top, age_bottom=age_bottom, page_size=page_size,
+                                   on_page=on_page)
+
+
+async def fetch_map_polygons_async(bbox, age_top=None, age_bottom=None, **kwargs):
+    return await asyncio.to_thread(fetch_map_polygons, bbox, age_top=age_top,
+                                   age_bottom=age_bottom, **kwargs)
+
+
+async def fetch_region_async(bbox, taxa=None, interval_name=None, age_top=None, age_bottom=None,
+                             polygon_index=None, adaptive=True, tiled=True, on_page=None):
+    """Fetch units, occurrences and map polygons for a region concurrently.
+
+    Each fetcher runs in a worker thread sharing the pooled api.client
+    session, so wall-clock time tracks the slowest upstream call. Units and
+    occurrences are only fetched when ``taxa`` is given; occurrences are
+    paged so no single PBDB request has to return the whole result set, and
+    ``on_page(n_records)`` is called from the worker threads as pages arrive.
+    Map polygons are sampled into ``polygon_index`` when one is passed (or
+    always in polygons-only mode), which also warms it for later per-group
+    lookups. With ``tiled`` every query is split into grid tiles by
+    api.tiling and cached per tile, so large regions don't time out and a
+    moved bbox only fetches the tiles it newly covers.
+    Returns a dict with "units", "occurrences" and "polygons" (None when skipped).
+    """
+    tasks = {}
+    cache = get_tile_cache() if tiled else None
+    if taxa and tiled:
+        tasks["units"] = asyncio.to_thread(fetch_units_tiled, bbox, interval_name=interval_name,
+                                           age_top=age_top, age_bottom=age_bottom, cache=cache)
+        tasks["occurrences"] = asyncio.to_thread(fetch_occurrences_tiled, bbox, taxa=taxa,
+                                                 age_top=age_top, age_bottom=age_bottom,
+                                                 page_size=PAGE_SIZE, on_page=on_page,
+                                                 cache=cache)
+    elif taxa:
+        tasks["units"] = fetch_units_async(bbox, interval_name=interval_name,
+                                           age_top=age_top, age_bottom=age_bottom)
+        tasks["occurrences"] = fetch_occurrences_async(bbox, taxa=taxa, age_top=age_top,
+                                                       age_bottom=age_bottom, page_size=PAGE_SIZE,
+                                                       on_page=on_page)
+    if (polygon_index is not None or not taxa) and tiled:
+        tasks["polygons"] = asyncio.to_thread(fetch_map_polygons_tiled, bbox, age_top=age_top,
+                                              age_bottom=age_bottom, polygon_index=polygon_index,
+                                              adaptive=adaptive, cache=cache)
+    elif polygon_index is not None or not taxa:
+        tasks["polygons"] = fetch_map_polygons_async(bbox, age_top=age_top, age_bottom=age_bottom,
+                                                     polygon_index=polygon_index, adaptive=adaptive)
+
+    results = await asyncio.gather(*tasks.values())
+    out = {"units": None, "occurrences": None, "polygons": None}
+    out.update(zip(tasks, results))
+    return out
+
+
+def fetch_region(bbox, taxa=None, interval_name=None, age_top=None, age_bottom=None,
+                 polygon_index=None, adaptive=True, tiled=True, on_page=None):
+    """Sync wrapper around fetch_region_async for callers without an event loop."""
+    return asyncio.run(fetch_region_async(
+        bbox, taxa=taxa, interval_name=interval_name, age_top=age_top, age_bottom=age_bottom,
+        polygon_index=polygon_index, adaptive=adaptive, tiled=tiled, on_page=on_page))
@@ -0,0 +1,116 @@
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from api import throttle
+
+POOL_SIZE = 16
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+BACKOFF_JITTER = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Longest Retry-After honored; a larger value is clamped to this
+MAX_RETRY_AFTER_S = 60.0
+
+_session = None
+_session_lock = threading.Lock()
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def _build_session(pool_size):
+    # Retries are done by get(), so that every attempt goes through the throttle
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """Return the shared keep-alive session used by every API module."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _build_session(POOL_SIZE)
+        return _session
+
+
+def _record(endpoint, elapsed, failed):
+    with _metrics_lock:
+        stats = _metrics.setdefault(
+            endpoint, {"requests": 0, "errors": 0, "total_s": 0.0, "max_s": 0.0})
+        stats["requests"] += 1
+        stats["errors"] += int(failed)
+        stats["total_s"] += elapsed
+        stats["max_s"] = max(stats["max_s"], elapsed)
+
+
+def _retry_delay(attempt, resp):
+    """Seconds to wait before retry ``attempt`` (0-based), honoring a numeric Retry-After."""
+    if resp is not None:
+        try:
+            return min(MAX_RETRY_AFTER_S, max(0.0, float(resp.headers.get("Retry-After", ""))))
+        except ValueError:
+            pass
+    return BACKOFF_FACTOR * (2 ** attempt) + random.uniform(0, BACKOFF_JITTER)
+
+
+def get(url, params=None, timeout=30):
+    """GET through the pooled session, retrying 429/5xx and connection errors with jittered backoff.
+
+    A read timeout is raised at once rather than retried: the server got
+    the request and was too slow answering it, so callers such as
+    api.tiling can split the query instead of waiting on it again.
+
+    Every attempt, retries included, first takes a token from the host's
+    rate limiter and a slot from its adaptive concurrency limit (see
+    api.throttle), and reports its outcome to the limit: throttling
+    statuses, other 5xx responses and connection errors count as unhealthy.
+    Latency and errors are recorded per attempt and endpoint (host + path).
+    """
+    parts = urlsplit(url)
+    endpoint = f"{parts.netloc}{parts.path}"
+    host = throttle.for_host(parts.netloc)
+    session = get_session()
+    for attempt in range(MAX_RETRIES + 1):
+        host.bucket.acquire()
+        host.limiter.acquire()
+        start = time.perf_counter()
+        resp = None
+        status = None
+        try:
+            resp = session.get(url, params=params, timeout=timeout)
+            status = resp.status_code
+        except requests.ConnectionError:
+            # Includes ConnectTimeout, but not ReadTimeout
+            if attempt >= MAX_RETRIES:
+                raise
+        finally:
+            elapsed = time.perf_counter() - start
+            host.limiter.release(elapsed, status=status, failed=status is None or status >= 500)
+            _record(endpoint, elapsed, failed=status is None or status >= 400)
+        if status is not None and (status not in RETRY_STATUSES or attempt >= MAX_RETRIES):
+            return resp
+        delay = _retry_delay(attempt, resp)
+        if resp is not None:
+            resp.close()
+        time.sleep(delay)
+
+
+def latency_stats():
+    """Return per-endpoint request counts, error counts and mean/max latency in seconds."""
+    with _metrics_lock:
+        return {
+            endpoint: {
+                "requests": s["requests"],
+                "errors": s["errors"],
+                "mean_s": s["total_s"] / s["requests"],
+                "max_s": s["max_s"],
+            }
+            for endpoint, s in _metrics.items()
+        }
@@ -1,25 +1,248 @@
 import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+import shapely
+from shapely.geometry import shape
+
+from api import client
 
 BASE_URL = "https://macrostrat.org/api/v2"
+MAP_MAX_WORKERS = 8
+# PolygonIndex rebuilds its STRtree once this many polygons (or a quarter of
+# the indexed ones, if more) were added since the last build
+INDEX_REBUILD_MIN = 64
+# Cached covers_box results kept per index
+BOX_COVER_CACHE_SIZE = 10_000
+
+logger = logging.getLogger(__name__)
+
+
+class PartialResult(list):
+    """Result list that is missing the answers of failed upstream requests.
+
+    Behaves like a normal list; callers that persist results (the map and
+    tile caches) must not store it.
+    """
 
 
-def fetch_map_at_point(lat, lng):
+_map_cache = None
+_map_cache_lock = threading.Lock()
+
+
+def get_map_cache():
+    """Return the process-wide map-at-point response cache, opening it on first use."""
+    global _map_cache
+    if _map_cache is None:
+        with _map_cache_lock:
+            if _map_cache is None:
+                from db.map_cache import MapPointCache
+                _map_cache = MapPointCache()
+    return _map_cache
+
+
+def fetch_map_at_point(lat, lng, use_cache=True):
     """Fetch geologic map polygons at a single lat/lng point.
 
-    Returns a list of GeoJSON feature dicts.
+    Successful responses are stored in the persistent map cache, keyed by the
+    point rounded to 0.01 degrees. Returns a list of GeoJSON feature dicts;
+    a failed request is logged and returns an empty PartialResult, which is
+    not cached.
     """
+    cache = get_map_cache() if use_cache else None
+    if cache is not None:
+        cached = cache.get(lat, lng)
+        if cached is not None:
+            return cached
     try:
-        resp = requests.get(
+        resp = client.get(
             f"{BASE_URL}/geologic_units/map",
             params={"lat": lat, "lng": lng, "format": "geojson_bare"},
             timeout=30,
         )
         resp.raise_for_status()
-        return resp.json().get("features", [])
-    except (requests.RequestException, ValueError):
-        return []
+        body = resp.json()
+        features = body.get("features") if isinstance(body, dict) else None
+        if not isinstance(features, list):
+            raise ValueError("response has no feature list")
+    except (requests.RequestException, ValueError) as exc:
+        logger.warning("Map lookup at (%s, %s) failed: %s", lat, lng, exc)
+        return PartialResult()
+    if cache is not None:
+        cache.put(lat, lng, features)
+    return features
+
+
+class PolygonIndex:
+    """In-memory spatial index over map polygons already fetched in a session.
+
+    Besides the polygons, the index remembers the full map-at-point response
+    of every point it has seen. A new point is answered locally only when the
+    known polygons covering it are exactly the polygons of one of those
+    responses, so overlapping polygons (e.g. other map scales) are never
+    dropped. Safe to share between threads.
+    """
+
+    def __init__(self):
+        self._features = []
+        self._geoms = []
+        self._seen_ids = set()
+        self._responses = {}
+        self._tree = None
+        self._indexed = 0
+        self._box_cover = {}
+        self._lock = threading.RLock()
+        self.local_hits = 0
+
+    def __len__(self):
+        return len(self._features)
+
+    def add(self, features):
+        """Index map polygons (deduplicated by map_id)."""
+        with self._lock:
+            self._add(features)
+
+    def _add(self, features):
+        for feat in features:
+            map_id = feat.get("properties", {}).get("map_id")
+            if not map_id or map_id in self._seen_ids or not feat.get("geometry"):
+                continue
+            try:
+                geom = shape(feat["geometry"])
+                if not geom.is_valid:
+                    geom = shapely.make_valid(geom)
+            except Exception:
+                continue
+            self._seen_ids.add(map_id)
+            self._features.append(feat)
+            self._geoms.append(geom)
+
+    def add_response(self, features):
+        """Index the polygons of one map-at-point response and remember the response."""
+        map_ids = frozenset(feat.get("properties", {}).get("map_id") for feat in features)
+        with self._lock:
+            self._add(features)
+            if features and map_ids <= self._seen_ids:
+                self._responses.setdefault(map_ids, features)
+
+    def update(self, other):
+        """Add the polygons and remembered responses of another index."""
+        with other._lock:
+            items = list(zip(other._features, other._geoms))
+            responses = dict(other._responses)
+        with self._lock:
+            for feat, geom in items:
+                map_id = feat["properties"]["map_id"]
+                if map_id not in self._seen_ids:
+                    self._seen_ids.add(map_id)
+                    self._features.append(feat)
+                    self._geoms.append(geom)
+            for map_ids, response in responses.items():
+                self._responses.setdefault(map_ids, response)
+
+    def _query(self, geom, predicate):
+        """Return sorted indices of the known polygons ``p`` with ``predicate(geom, p)``.
+
+        Polygons added since the STRtree was built are tested directly; the
+        tree is rebuilt only once enough of them have accumulated.
+        """
+        if not self._geoms:
+            return []
+        pending = len(self._geoms) - self._indexed
+        if self._tree is None or pending > max(INDEX_REBUILD_MIN, self._indexed // 4):
+            self._tree = shapely.STRtree(self._geoms)
+            self._indexed = len(self._geoms)
+            pending = 0
+        hits = self._tree.query(geom, predicate=predicate).tolist()
+        if pending:
+            matches = getattr(shapely, predicate)(geom, self._geoms[self._indexed:])
+            hits.extend(self._indexed + i for i in matches.nonzero()[0].tolist())
+        return sorted(hits)
+
+    def _response_at(self, lat, lng):
+        with self._lock:
+            hits = self._query(shapely.Point(lng, lat), "covered_by")
+            if not hits:
+                return None
+            map_ids = frozenset(self._features[i]["properties"]["map_id"] for i in hits)
+            return self._responses.get(map_ids)
+
+    def covering(self, lat, lng):
+        """Return the map-at-point response for a point if it is known locally, else None."""
+        response = self._response_at(lat, lng)
+        if response is not None:
+            self.local_hits += 1
+        return response
+
+    def covers_point(self, lat, lng):
+        return self._response_at(lat, lng) is not None
+
+    def covers_box(self, lngmin, latmin, lngmax, latmax):
+        """Return True if the known polygons together cover the whole box.
+
+        The box's corners and center are tested first, so most uncovered
+        boxes are rejected without a union. Union results are cached until
+        the polygons intersecting the box change.
+        """
+        with self._lock:
+            return self._covers_box(lngmin, latmin, lngmax, latmax)
+
+    def _covers_box(self, lngmin, latmin, lngmax, latmax):
+        key = (lngmin, latmin, lngmax, latmax)
+        cached = self._box_cover.get(key)
+        if cached is not None and cached[1]:
+            return True
+        xm, ym = (lngmin + lngmax) / 2, (latmin + latmax) / 2
+        for x, y in ((xm, ym), (lngmin, latmin), (lngmax, latmin), (lngmin, latmax), (lngmax, latmax)):
+            if not self._query(shapely.Point(x, y), "covered_by"):
+                return False
+        cell = shapely.box(lngmin, latmin, lngmax, latmax)
+        hits = tuple(self._query(cell, "intersects"))
+        if cached is not None and cached[0] == hits:
+            return cached[1]
+        if any(self._geoms[i].covers(cell) for i in hits):
+            covered = True
+        else:
+            try:
+                parts = shapely.intersection([self._geoms[i] for i in hits], cell)
+                covered = shapely.union_all(parts).covers(cell)
+            except shapely.errors.GEOSException:
+                covered = False
+        if len(self._box_cover) >= BOX_COVER_CACHE_SIZE:
+            self._box_cover.clear()
+        self._box_cover[key] = (hits, covered)
+        return covered
+
+
+def fetch_map_at_points(points, max_workers=MAP_MAX_WORKERS, polygon_index=None):
+    """Fetch geologic map polygons at many (lat, lng) points concurrently.
+
+    Yields one list of GeoJSON feature dicts per point, in the order of
+    ``points``, with at most ``max_workers`` requests in flight.
+
+    With a ``polygon_index``, points are dispatched in batches of
+    ``max_workers``; before each batch, points the index can answer exactly
+    are answered locally, and every response is added to the index.
+    """
+    points = list(points)
+    if not points:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(points)))) as executor:
+        if polygon_index is None:
+            yield from executor.map(lambda p: fetch_map_at_point(*p), points)
+            return
+        for start in range(0, len(points), max_workers):
+            batch = points[start:start + max_workers]
+            local = [polygon_index.covering(lat, lng) for lat, lng in batch]
+            remote = executor.map(lambda p: fetch_map_at_point(*p),
+                                  [p for p, feats in zip(batch, local) if feats is None])
+            for feats in local:
+                if feats is None:
+                    feats = next(remote)
+                    polygon_index.add_response(feats)
+                yield feats
 
 
 def _linspace(start, stop, n):
@@ -29,19 +252,72 @@ def _linspace(start, stop, n):
     return [start + i * step for i in range(n)]
 
 
-def fetch_map_polygons(bbox, age_top=None, age_bottom=None, grid_n=5):
+def _sample_adaptive(bbox, polygon_index, max_requests, max_workers, max_depth):
+    """Sample map polygons by recursively subdividing the bounding box.
+
+    Each cell is sampled at its center; a cell is refined into quadrants only
+    while the polygons fetched so far do not cover it. Cells are processed a
+    level at a time, and sampling stops once ``max_requests`` map requests
+    have been sent. Yields one feature list per sampled point.
+    """
+    cells = [(bbox["lngmin"], bbox["latmin"], bbox["lngmax"], bbox["latmax"])]
+    budget = max_requests
+    for _ in range(max_depth + 1):
+        if not cells or budget <= 0:
+            break
+        # Centers the index can answer are answered locally and cost nothing;
+        # if the remaining budget can't cover every other cell, spread it evenly
+        level = [(cell, ((cell[1] + cell[3]) / 2, (cell[0] + cell[2]) / 2)) for cell in cells]
+        remote = [i for i, (_, center) in enumerate(level) if not polygon_index.covers_point(*center)]
+        if len(remote) > budget:
+            keep = {remote[i * len(remote) // budget] for i in range(budget)}
+            skip = set(remote) - keep
+            level = [item for i, item in enumerate(level) if i not in skip]
+        budget -= min(len(remote), budget)
+
+        yield from fetch_map_at_points([center for _, center in level], max_workers=max_workers,
+                                       polygon_index=polygon_index)
+
+        cells = []
+        for (x0, y0, x1, y1), _ in level:
+            if polygon_index.covers_box(x0, y0, x1, y1):
+                continue
+            xm, ym = (x0 + x1) / 2, (y0 + y1) / 2
+            cells.extend([(x0, y0, xm, ym), (xm, y0, x1, ym), (x0, ym, xm, y1), (xm, ym, x1, y1)])
+
+
+def fetch_map_polygons(bbox, age_top=None, age_bottom=None, grid_n=5, max_workers=MAP_MAX_WORKERS,
+                       polygon_index=None, adaptive=False, max_requests=None, max_depth=6):
     """Fetch geologic map polygons across a bounding box by sampling a grid.
 
-    Optionally filters by age range. Returns deduplicated GeoJSON feature dicts.
+    Optionally filters by age range. Grid points ``polygon_index`` (a fresh
+    index by default) can answer exactly are answered locally.
+
+    With ``adaptive=True`` the fixed grid is replaced by quadtree sampling
+    that refines only cells not yet covered by fetched polygons, spending at
+    most ``max_requests`` map requests (``grid_n ** 2`` by default).
+    Returns deduplicated GeoJSON feature dicts, as a PartialResult if any
+    map request failed.
     """
-    lats = _linspace(bbox["latmin"], bbox["latmax"], grid_n)
-    lngs = _linspace(bbox["lngmin"], bbox["lngmax"], grid_n)
+    if polygon_index is None:
+        polygon_index = PolygonIndex()
+
+    if adaptive:
+        if max_requests is None:
+            max_requests = grid_n * grid_n
+        results = _sample_adaptive(bbox, polygon_index, max_requests, max_workers, max_depth)
+    else:
+        lats = _linspace(bbox["latmin"], bbox["latmax"], grid_n)
+        lngs = _linspace(bbox["lngmin"], bbox["lngmax"], grid_n)
+        points = list(itertools.product(lats, lngs))
+        results = fetch_map_at_points(points, max_workers=max_workers, polygon_index=polygon_index)
 
     seen_ids = set()
     features = []
+    partial = False
 
-    for lat, lng in itertools.product(lats, lngs):
-        feats = fetch_map_at_point(lat, lng)
+    for feats in results:
+        partial = partial or isinstance(feats, PartialResult)
         for feat in feats:
             props = feat.get("properties", {})
             map_id = props.get("map_id")
@@ -61,7 +337,7 @@ def fetch_map_polygons(bbox, age_top=None, age_bottom=None, grid_n=5):
             seen_ids.add(map_id)
             features.append(feat)
 
-    return features
+    return PartialResult(features) if partial else features
 
 
 def fetch_units(bbox, interval_name=None, age_top=None, age_bottom=None):
@@ -80,7 +356,7 @@ def fetch_units(bbox, interval_name=None, age_top=None, age_bottom=None):
     if age_bottom is not None:
         params["age_bottom"] = age_bottom
 
-    resp = requests.get(f"{BASE_URL}/units", params=params, timeout=60)
+    resp = client.get(f"{BASE_URL}/units", params=params, timeout=60)
     resp.raise_for_status()
     data = resp.json().get("success", {}).get("data", [])
     return data
@@ -101,7 +377,7 @@ def fetch_fossils(bbox, interval_name=None, age_top=None, age_bottom=None):
     if age_bottom is not None:
         params["age_bottom"] = age_bottom
 
-    resp = requests.get(f"{BASE_URL}/fossils", params=params, timeout=60)
+    resp = client.get(f"{BASE_URL}/fossils", params=params, timeout=60)
     resp.raise_for_status()
     data = resp.json().get("success", {}).get("data", [])
     return data
@@ -1,9 +1,10 @@
-import requests
+from api import client
 
 BASE_URL = "https://paleobiodb.org/data1.2"
+PAGE_SIZE = 5000
 
 
-def fetch_occurrences(bbox, taxa=None, interval=None, age_top=None, age_bottom=None):
+def _occurrence_params(bbox, taxa=None, interval=None, age_top=None, age_bottom=None):
     params = {
         "lngmin": bbox["lngmin"],
         "lngmax": bbox["lngmax"],
@@ -11,7 +12,6 @@ def fetch_occurrences(bbox, taxa=None, interval=None, age_top=None, age_bottom=N
         "latmax": bbox["latmax"],
         "show": "coords,stratext,strat,geo,loc",
         "vocab": "pbdb",
-        "limit": "all",
     }
     if taxa:
         if isinstance(taxa, list):
@@ -24,9 +24,64 @@ def fetch_occurrences(bbox, taxa=None, interval=None, age_top=None, age_bottom=N
         params["min_ma"] = age_top
     if age_bottom is not None:
         params["max_ma"] = age_bottom
+    return params
 
-    resp = requests.get(f"{BASE_URL}/occs/list.json", params=params, timeout=120)
+
+def iter_occurrences(bbox, taxa=None, interval=None, age_top=None, age_bottom=None,
+                     page_size=PAGE_SIZE, on_page=None):
+    """Yield PBDB occurrence records page by page.
+
+    Each request asks for at most ``page_size`` records, so peak memory and
+    per-request time stay bounded and the first records arrive before the
+    whole result set has been downloaded. ``on_page(n_records)`` is called
+    as each page arrives. Pages are requested in occurrence id order so
+    limit/offset windows don't overlap, and a record repeated across pages
+    (e.g. after an insert shifted the offsets) is only yielded once.
+    """
+    params = _occurrence_params(bbox, taxa=taxa, interval=interval,
+                                age_top=age_top, age_bottom=age_bottom)
+    params["order"] = "id"
+    seen = set()
+    offset = 0
+    while True:
+        resp = client.get(f"{BASE_URL}/occs/list.json",
+                          params={**params, "limit": page_size, "offset": offset}, timeout=120)
+        resp.raise_for_status()
+        records = resp.json().get("records", [])
+        if on_page is not None:
+            on_page(len(records))
+        for rec in records:
+            occurrence_no = rec.get("occurrence_no")
+            if occurrence_no is not None:
+                if occurrence_no in seen:
+                    continue
+                seen.add(occurrence_no)
+            yield rec
+        if len(records) < page_size:
+            return
+        offset += page_size
+
+
+def fetch_occurrences(bbox, taxa=None, interval=None, age_top=None, age_bottom=None, page_size=None,
+                      on_page=None):
+    """Fetch PBDB occurrences as a list.
+
+    With ``page_size`` the records are fetched in pages via iter_occurrences;
+    otherwise everything is requested at once with ``limit=all``.
+    ``on_page(n_records)`` is called for every page (once without paging).
+    """
+    if page_size:
+        return list(iter_occurrences(bbox, taxa=taxa, interval=interval, age_top=age_top,
+                                     age_bottom=age_bottom, page_size=page_size,
+                                     on_page=on_page))
+
+    params = _occurrence_params(bbox, taxa=taxa, interval=interval,
+                                age_top=age_top, age_bottom=age_bottom)
+    params["limit"] = "all"
+    resp = client.get(f"{BASE_URL}/occs/list.json", params=params, timeout=120)
     resp.raise_for_status()
     data = resp.json()
     records = data.get("records", [])
+    if on_page is not None:
+        on_page(len(records))
     return records
@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Sized
+from concurrent.futures import Future
+
+QUERY_TTL_SECONDS = 15 * 60
+QUERY_MAX_ENTRIES = 32
+QUERY_MAX_RECORDS = 2_000_000
+
+
+def query_key(bbox, taxa=None, **params):
+    """Normalize query parameters into a cache key.
+
+    The bbox is rounded to 4 decimal places and taxa are trimmed, lowercased,
+    deduplicated and sorted, so equivalent queries share a key.
+    """
+    if isinstance(taxa, str):
+        taxa = taxa.split(",")
+    norm = {
+        "bbox": {k: round(float(v), 4) for k, v in sorted(bbox.items())},
+        "taxa": sorted({t.strip().lower() for t in taxa or [] if t.strip()}),
+        **params,
+    }
+    return json.dumps(norm, sort_keys=True, default=str)
+
+
+def _size(value):
+    if isinstance(value, dict):
+        return sum(_size(v) for v in value.values())
+    if isinstance(value, (str, bytes)):
+        return 1
+    if isinstance(value, Sized):
+        return len(value)
+    return 1
+
+
+class QueryCache:
+    """Process-wide TTL cache for query results with request coalescing.
+
+    Concurrent get_or_fetch calls for the same key share one in-flight fetch
+    ("single-flight"); the others wait for its result. Completed results are
+    kept for ``ttl_seconds`` and evicted least-recently-used once there are
+    more than ``max_entries`` of them or they hold more than ``max_records``
+    records in total. Cached results are shared and must not be mutated.
+    """
+
+    def __init__(self, ttl_seconds=QUERY_TTL_SECONDS, max_entries=QUERY_MAX_ENTRIES,
+                 max_records=QUERY_MAX_RECORDS):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_records = max_records
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._records = 0
+        self._lock = threading.Lock()
+
+    def get_or_fetch(self, key, fetch, cacheable=None):
+        """Return the cached result for ``key``, calling ``fetch()`` at most once per miss.
+
+        A result for which ``cacheable(result)`` is false is handed to the
+        callers waiting on this fetch but not stored.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = self._in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+
+        try:
+            value = fetch()
+        except BaseException as exc:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(exc)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            if cacheable is None or cacheable(value):
+                self._store(key, value)
+        future.set_result(value)
+        return value
+
+    def _store(self, key, value):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._records -= old[2]
+        size = _size(value)
+        self._entries[key] = (time.monotonic(), value, size)
+        self._records += size
+        while self._entries and (len(self._entries) > self.max_entries
+                                 or self._records > self.max_records):
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self._records -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._records = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                    "entries": len(self._entries), "records": self._records}
@@ -0,0 +1,140 @@
+import threading
+import time
+
+# Requests per second and burst size per upstream host
+HOST_RATES = {
+    "macrostrat.org": (10.0, 20),
+    "paleobiodb.org": (5.0, 10),
+}
+DEFAULT_RATE = (10.0, 20)
+INITIAL_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 16
+LATENCY_TARGET_S = 10.0
+# Slowest healthy response per host, where normal requests take longer than
+# LATENCY_TARGET_S (PBDB pages of thousands of occurrences)
+HOST_LATENCY_TARGETS = {
+    "paleobiodb.org": 60.0,
+}
+THROTTLE_STATUSES = (429, 503)
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at ``rate`` tokens per second up to ``burst``."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited_s = 0.0
+
+    def acquire(self):
+        """Take one token, sleeping until one is available. Returns seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.waited_s += waited
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AIMDLimiter:
+    """Concurrency limit with additive increase / multiplicative decrease.
+
+    The limit grows by one after ``limit`` consecutive healthy responses and
+    halves on a throttling status (429/503), a timeout, or a response slower
+    than ``latency_target``.
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY,
+                 maximum=MAX_CONCURRENCY, latency_target=LATENCY_TARGET_S):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.throttle_events = 0
+        self.decreases = 0
+        self._healthy = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, status=None, failed=False):
+        with self._cond:
+            self.in_flight -= 1
+            throttled = status in THROTTLE_STATUSES
+            if throttled:
+                self.throttle_events += 1
+            if throttled or failed or latency > self.latency_target:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.decreases += 1
+                self._healthy = 0
+            else:
+                self._healthy += 1
+                if self._healthy >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self._healthy = 0
+            self._cond.notify_all()
+
+
+class HostThrottle:
+    def __init__(self, rate, burst, latency_target=LATENCY_TARGET_S):
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = AIMDLimiter(latency_target=latency_target)
+
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def _host_key(netloc):
+    host = netloc.split(":")[0]
+    for known in HOST_RATES:
+        if host == known or host.endswith("." + known):
+            return known
+    return host
+
+
+def for_host(netloc):
+    """Return the process-wide throttle for a host, creating it on first use."""
+    key = _host_key(netloc)
+    with _hosts_lock:
+        throttle = _hosts.get(key)
+        if throttle is None:
+            throttle = _hosts[key] = HostThrottle(
+                *HOST_RATES.get(key, DEFAULT_RATE),
+                latency_target=HOST_LATENCY_TARGETS.get(key, LATENCY_TARGET_S))
+        return throttle
+
+
+def throttle_stats():
+    """Return current rate, concurrency limit and throttle counters per host."""
+    with _hosts_lock:
+        items = list(_hosts.items())
+    return {
+        host: {
+            "rate": t.bucket.rate,
+            "burst": t.bucket.burst,
+            "concurrency_limit": t.limiter.limit,
+            "latency_target_s": t.limiter.latency_target,
+            "in_flight": t.limiter.in_flight,
+            "throttle_events": t.limiter.throttle_events,
+            "decreases": t.limiter.decreases,
+            "wait_s": t.bucket.waited_s,
+        }
+        for host, t in items
+    }
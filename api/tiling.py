@@ -0,0 +1,310 @@
+import json
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from api.macrostrat import PartialResult, fetch_map_polygons, fetch_units
+from api.paleobiodb import fetch_occurrences
+
+TILE_DEG = 5.0
+MAX_SPLIT_DEPTH = 4
+TILE_MAX_WORKERS = 4
+# Map requests per whole grid cell; partly covered cells get a share by area
+TILE_MAP_REQUESTS = 9
+# Fewest map requests spent on a whole bbox, however small (the untiled 5x5 grid)
+MIN_MAP_REQUESTS = 25
+# Grid that cached tiles of partly covered cells are snapped to, and the
+# share of such a cell the bbox must cover for a filtered query to fetch it whole
+FINE_TILE_DEG = 1.0
+WHOLE_CELL_FRACTION = 0.5
+
+_tile_cache = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache():
+    """Return the process-wide per-tile result cache, opening it on first use."""
+    global _tile_cache
+    if _tile_cache is None:
+        with _tile_cache_lock:
+            if _tile_cache is None:
+                from db.tile_cache import TileCache
+                _tile_cache = TileCache()
+    return _tile_cache
+
+
+def grid_cells(bbox, tile_deg=TILE_DEG):
+    """Return (row, col) positions of the global ``tile_deg`` grid cells a bbox touches."""
+    lat0 = math.floor(bbox["latmin"] / tile_deg)
+    lng0 = math.floor(bbox["lngmin"] / tile_deg)
+    lat1 = max(lat0 + 1, math.ceil(bbox["latmax"] / tile_deg))
+    lng1 = max(lng0 + 1, math.ceil(bbox["lngmax"] / tile_deg))
+    return [(row, col) for row in range(lat0, lat1) for col in range(lng0, lng1)]
+
+
+def cell_bbox(row, col, tile_deg=TILE_DEG):
+    return {
+        "latmin": row * tile_deg,
+        "latmax": (row + 1) * tile_deg,
+        "lngmin": col * tile_deg,
+        "lngmax": (col + 1) * tile_deg,
+    }
+
+
+def _grid_tiles(bbox, tile_deg):
+    """Return (row, col, tile) for every grid cell a bbox overlaps, ``tile`` being the overlap."""
+    tiles = []
+    for row, col in grid_cells(bbox, tile_deg):
+        cell = cell_bbox(row, col, tile_deg)
+        tile = {
+            "latmin": max(bbox["latmin"], cell["latmin"]),
+            "latmax": min(bbox["latmax"], cell["latmax"]),
+            "lngmin": max(bbox["lngmin"], cell["lngmin"]),
+            "lngmax": min(bbox["lngmax"], cell["lngmax"]),
+        }
+        if tile["latmin"] < tile["latmax"] and tile["lngmin"] < tile["lngmax"]:
+            tiles.append((row, col, tile))
+    return tiles
+
+
+def split_bbox(bbox, tile_deg=TILE_DEG):
+    """Split a bbox along a global grid of ``tile_deg`` cells.
+
+    Returns tile bboxes (the bbox clipped to each grid cell) in row-major
+    order from the south-west corner.
+    """
+    return [tile for _, _, tile in _grid_tiles(bbox, tile_deg)] or [dict(bbox)]
+
+
+def _area(bbox):
+    return (bbox["latmax"] - bbox["latmin"]) * (bbox["lngmax"] - bbox["lngmin"])
+
+
+def _snap(bbox, deg, outward=True):
+    """Move a bbox's edges onto the ``deg`` grid, outward or inward."""
+    lower, upper = (math.floor, math.ceil) if outward else (math.ceil, math.floor)
+    return {
+        "latmin": lower(bbox["latmin"] / deg) * deg,
+        "latmax": upper(bbox["latmax"] / deg) * deg,
+        "lngmin": lower(bbox["lngmin"] / deg) * deg,
+        "lngmax": upper(bbox["lngmax"] / deg) * deg,
+    }
+
+
+def _frame(outer, inner):
+    """Split ``outer`` minus a contained ``inner`` bbox into up to four strips."""
+    strips = [
+        {**outer, "latmax": inner["latmin"]},
+        {**outer, "latmin": inner["latmax"]},
+        {**inner, "lngmin": outer["lngmin"], "lngmax": inner["lngmin"]},
+        {**inner, "lngmin": inner["lngmax"], "lngmax": outer["lngmax"]},
+    ]
+    return [b for b in strips if b["latmin"] < b["latmax"] and b["lngmin"] < b["lngmax"]]
+
+
+def _cache_tiles(bbox, tile_deg, fine_deg, filtered):
+    """Plan the cached tiles of a bbox as (clip, row, col, tile) tuples.
+
+    Cells inside the bbox are fetched whole. When records can be
+    ``filtered`` to the bbox, a partly covered cell is fetched whole too if
+    the bbox covers at least WHOLE_CELL_FRACTION of it, and otherwise as its
+    overlap snapped out to the ``fine_deg`` grid. Without a filter the
+    overlap is fetched as its part snapped in to the ``fine_deg`` grid plus
+    the thin strips around it, so every tile stays inside the bbox. The
+    snapped tiles are what a slightly moved bbox fetches again from the
+    cache. ``clip`` is the tile's bounds when it is not the whole
+    ``(row, col)`` cell, else None.
+    """
+    tiles = []
+    for row, col, overlap in _grid_tiles(bbox, tile_deg):
+        cell = cell_bbox(row, col, tile_deg)
+        if overlap == cell or (filtered and _area(overlap) >= WHOLE_CELL_FRACTION * _area(cell)):
+            tiles.append((None, row, col, cell))
+            continue
+        if filtered:
+            parts = [_snap(overlap, fine_deg)]
+        else:
+            inner = _snap(overlap, fine_deg, outward=False)
+            if inner["latmin"] < inner["latmax"] and inner["lngmin"] < inner["lngmax"]:
+                parts = [inner] + _frame(overlap, inner)
+            else:
+                parts = [overlap]
+        tiles.extend((part, row, col, part) for part in parts)
+    return tiles
+
+
+def _quarter(bbox):
+    latmid = (bbox["latmin"] + bbox["latmax"]) / 2
+    lngmid = (bbox["lngmin"] + bbox["lngmax"]) / 2
+    return [
+        {"latmin": bbox["latmin"], "latmax": latmid, "lngmin": bbox["lngmin"], "lngmax": lngmid},
+        {"latmin": bbox["latmin"], "latmax": latmid, "lngmin": lngmid, "lngmax": bbox["lngmax"]},
+        {"latmin": latmid, "latmax": bbox["latmax"], "lngmin": bbox["lngmin"], "lngmax": lngmid},
+        {"latmin": latmid, "latmax": bbox["latmax"], "lngmin": lngmid, "lngmax": bbox["lngmax"]},
+    ]
+
+
+def _point_filter(lat_key, lng_key):
+    """Keep records whose (lat_key, lng_key) point lies in the bbox; keep unlocated ones."""
+    def keep(record, bbox):
+        lat, lng = record.get(lat_key), record.get(lng_key)
+        if lat is None or lng is None:
+            return True
+        lat, lng = float(lat), float(lng)
+        return (bbox["latmin"] <= lat <= bbox["latmax"]
+                and bbox["lngmin"] <= lng <= bbox["lngmax"])
+    return keep
+
+
+def _query_key(fetch_fn, params):
+    return json.dumps([fetch_fn.__name__, params], sort_keys=True, default=str)
+
+
+def fetch_tiled(fetch_fn, bbox, key, tile_deg=TILE_DEG, max_depth=MAX_SPLIT_DEPTH,
+                max_workers=TILE_MAX_WORKERS, cache=None, record_filter=None,
+                fine_deg=FINE_TILE_DEG, **kwargs):
+    """Fetch records for a bbox tile by tile and merge them.
+
+    ``fetch_fn(tile_bbox, **kwargs)`` is called for every tile in parallel.
+    A tile that times out or fails with a server error (5xx) is split into
+    quadrants and fetched again, up to ``max_depth`` times; a tile that
+    returned its records is kept whole, however many there are. Records are
+    merged in tile order and deduplicated by ``record[key]`` (or ``key(record)``
+    when ``key`` is callable).
+
+    With a ``cache`` (a db.tile_cache.TileCache), results are stored per
+    grid cell under the query parameters and cells already cached are not
+    fetched again, so moving the bbox only fetches the cells it newly
+    touches. Cells inside the bbox are fetched whole; how partly covered
+    cells are cut into cacheable tiles is described in _cache_tiles, with
+    ``record_filter(record, bbox)`` narrowing records of tiles reaching past
+    the bbox to it exactly (e.g. by point location). Without a filter every
+    tile lies within the bbox, so results match an uncached fetch. Tiles
+    with a PartialResult from ``fetch_fn`` are not cached, and make the
+    merged result a PartialResult too.
+    """
+    tiles = _grid_tiles(bbox, tile_deg)
+    if cache is None or not tiles:
+        level = [((i,), tile, 0) for i, tile in enumerate(split_bbox(bbox, tile_deg))]
+        cached = []
+        cache = None
+    else:
+        query = _query_key(fetch_fn, kwargs)
+        cells = {}
+        level, cached = [], []
+        plan = _cache_tiles(bbox, tile_deg, fine_deg, record_filter is not None)
+        for i, (clip, row, col, tile) in enumerate(plan):
+            tile_query = query if clip is None else _query_key(fetch_fn, {**kwargs, "clip": clip})
+            cells[(i,)] = (tile_query, tile_deg, row, col)
+            records = cache.get(tile_query, tile_deg, row, col)
+            if records is None:
+                level.append(((i,), tile, 0))
+            else:
+                cached.append(((i,), records))
+    done = []
+
+    def _fetch(item):
+        path, tile, depth = item
+        try:
+            return fetch_fn(tile, **kwargs)
+        except (requests.Timeout, requests.HTTPError) as exc:
+            # Too large a tile can time out or fail server-side; smaller ones may not
+            too_large = (isinstance(exc, requests.Timeout)
+                         or (exc.response is not None and exc.response.status_code >= 500))
+            if depth >= max_depth or not too_large:
+                raise
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while level:
+            next_level = []
+            for (path, tile, depth), records in zip(level, executor.map(_fetch, level)):
+                if records is None:
+                    next_level.extend((path + (i,), sub, depth + 1)
+                                      for i, sub in enumerate(_quarter(tile)))
+                else:
+                    done.append((path, records))
+            level = next_level
+    partial = any(isinstance(records, PartialResult) for _, records in done)
+
+    if cache is not None:
+        fetched, partial = {}, set()
+        for path, records in sorted(done, key=lambda item: item[0]):
+            fetched.setdefault(path[:1], []).extend(records)
+            if isinstance(records, PartialResult):
+                partial.add(path[:1])
+        for top, records in fetched.items():
+            if top not in partial:
+                cache.put(*cells[top], records)
+        done = list(fetched.items())
+
+    seen = set()
+    merged = []
+    for _, records in sorted(done + cached, key=lambda item: item[0]):
+        for rec in records:
+            rec_id = key(rec) if callable(key) else rec.get(key)
+            if rec_id is not None:
+                if rec_id in seen:
+                    continue
+                seen.add(rec_id)
+            if cache is not None and record_filter is not None and not record_filter(rec, bbox):
+                continue
+            merged.append(rec)
+    return PartialResult(merged) if partial else merged
+
+
+def fetch_units_tiled(bbox, interval_name=None, age_top=None, age_bottom=None, **tile_kwargs):
+    # A unit's column can reach into the bbox from a centroid outside it, so
+    # partly covered cells are fetched for their overlap instead of filtered
+    return fetch_tiled(fetch_units, bbox, "unit_id",
+                       interval_name=interval_name, age_top=age_top, age_bottom=age_bottom,
+                       **tile_kwargs)
+
+
+def fetch_occurrences_tiled(bbox, taxa=None, interval=None, age_top=None, age_bottom=None,
+                            page_size=None, on_page=None, **tile_kwargs):
+    """Fetch PBDB occurrences tile by tile; ``on_page(n_records)`` is called per fetched page."""
+    def _fetch_tile(tile, **kwargs):
+        return fetch_occurrences(tile, on_page=on_page, **kwargs)
+    _fetch_tile.__name__ = "fetch_occurrences"
+
+    if isinstance(taxa, list):
+        taxa = sorted({t.strip() for t in taxa if t.strip()})
+    return fetch_tiled(_fetch_tile, bbox, "occurrence_no",
+                       record_filter=_point_filter("lat", "lng"), taxa=taxa, interval=interval,
+                       age_top=age_top, age_bottom=age_bottom, page_size=page_size, **tile_kwargs)
+
+
+def fetch_map_polygons_tiled(bbox, age_top=None, age_bottom=None, polygon_index=None,
+                             adaptive=True, max_requests=TILE_MAP_REQUESTS,
+                             min_requests=MIN_MAP_REQUESTS, **tile_kwargs):
+    """Sample map polygons tile by tile.
+
+    The bbox gets ``max_requests`` map requests per whole grid cell, but
+    never fewer than ``min_requests`` in total, and every tile gets a share
+    of that budget by area. Tiles are sampled adaptively or on a grid. Cells
+    the bbox only partly covers are sampled over the overlap alone, so the
+    sampling density inside ``bbox`` is about the same with or without a
+    tile cache.
+    """
+    tile_deg = tile_kwargs.get("tile_deg", TILE_DEG)
+    area = (bbox["latmax"] - bbox["latmin"]) * (bbox["lngmax"] - bbox["lngmin"])
+    # Requests per square degree; part of the cache key, so equal densities share tiles
+    density = max_requests / tile_deg ** 2
+    if area > 0:
+        density = round(max(density, min_requests / area), 6)
+
+    def _fetch_tile(tile, age_top=None, age_bottom=None, adaptive=True, density=density):
+        tile_area = (tile["latmax"] - tile["latmin"]) * (tile["lngmax"] - tile["lngmin"])
+        budget = max(1, math.ceil(density * tile_area - 1e-9))
+        return fetch_map_polygons(tile, age_top=age_top, age_bottom=age_bottom,
+                                  grid_n=max(1, round(math.sqrt(budget))),
+                                  polygon_index=polygon_index, adaptive=adaptive,
+                                  max_requests=budget)
+    _fetch_tile.__name__ = "fetch_map_polygons"
+
+    return fetch_tiled(_fetch_tile, bbox, lambda feat: feat.get("properties", {}).get("map_id"),
+                       max_depth=0, age_top=age_top, age_bottom=age_bottom, adaptive=adaptive,
+                       density=density, **tile_kwargs)
@@ -1,6 +1,5 @@
-import io
-import json
-import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 
 import folium
@@ -8,11 +7,21 @@ import streamlit as st
 from folium.plugins import Draw
 from streamlit_folium import st_folium
 
-from api.macrostrat import fetch_map_polygons, fetch_units
-from api.paleobiodb import fetch_occurrences
+from api.aio import fetch_region
+from api.client import latency_stats
+from api.macrostrat import PartialResult, PolygonIndex, get_map_cache
+from api.query_cache import QueryCache, query_key
+from api.throttle import throttle_stats
+from api.tiling import get_tile_cache
 from db.intervals import ensure_cache_fresh, get_intervals, init_db
 from processing.correlate import build_stage_unit_groups, fetch_polygons_for_groups
-from processing.geojson_export import export_geojson, export_polygon_geojson
+from processing.geojson_export import EXPORT_FORMATS, export_all_geojson, export_polygon_geojson
+from processing.occurrence_map import (CLUSTER_MAX_POINTS, MARKER_LIMIT, add_occurrences,
+                                      stage_colors)
+from processing.occurrence_store import OccurrenceStore, compact_groups
+from processing.preview_cache import get_preview_cache, preview_files
+from processing.vector_tiles import export_vector_tiles
+from processing.zip_export import ExportArchive
 
 st.set_page_config(page_title="GeoJSONify Macro|Paleo", layout="wide")
 st.title("GeoJSONify Macro|Paleo")
@@ -34,6 +43,35 @@ def load_intervals(include_regional):
     return intervals
 
 
+@st.cache_resource
+def shared_query_cache():
+    # One cache per server process, shared by every session
+    return QueryCache()
+
+
+def fetch_compact(bbox, **kwargs):
+    # Occurrences are kept as a compact column store, both in the shared
+    # query cache and in each session's state. Polygons are sampled into an
+    # index of the fetch's own, kept with the result so every session that
+    # shares it can warm its index from it.
+    polygon_index = PolygonIndex()
+    fetched = fetch_region(bbox, polygon_index=polygon_index, **kwargs)
+    fetched = {**fetched, "polygon_index": polygon_index}
+    if fetched.get("occurrences") is not None:
+        fetched["occurrences"] = OccurrenceStore(fetched["occurrences"])
+    return fetched
+
+
+FORMAT_LABELS = {"geojson": "GeoJSON", "geoparquet": "GeoParquet", "flatgeobuf": "FlatGeobuf"}
+EXPORT_EXTENSIONS = {f["extension"] for f in EXPORT_FORMATS.values()} | {".mbtiles", ".pmtiles"}
+
+
+def exported_files(output_dir):
+    if not output_dir.exists():
+        return []
+    return [f for f in output_dir.iterdir() if f.suffix in EXPORT_EXTENSIONS]
+
+
 # ── Sidebar ─────────────────────────────────────────────────────────────────
 with st.sidebar:
     st.header("Region")
@@ -119,10 +157,31 @@ with st.sidebar:
     st.divider()
     st.header("Taxa (optional)")
     taxa_input = st.text_area("Comma-separated taxa (leave empty for polygons only)", value="", height=80)
+    map_render_mode = st.radio(
+        f"Occurrence map above {MARKER_LIMIT:,} points", options=["grid", "cluster"],
+        format_func=lambda m: {"grid": "Grid bins per stage", "cluster": "Marker clusters"}[m],
+        horizontal=True,
+        help="Grid bins keep the page small for any result size; clusters fall back to "
+             f"grid bins above {CLUSTER_MAX_POINTS:,} points")
+    adaptive_sampling = st.checkbox(
+        "Adaptive polygon sampling", value=True,
+        help="Refine the polygons-only sample grid where the map is not yet covered")
 
     st.divider()
     fetch_btn = st.button("Fetch Data", type="primary", width="stretch")
 
+    with st.expander("Upstream API metrics"):
+        st.caption("Rate limits and adaptive concurrency per host")
+        st.dataframe([{"Host": host, **stats} for host, stats in throttle_stats().items()],
+                     width="stretch")
+        st.caption("Latency per endpoint")
+        st.dataframe([{"Endpoint": ep, **stats} for ep, stats in latency_stats().items()],
+                     width="stretch")
+
+# Polygons fetched this session, used to answer covered points without a request
+if "polygon_index" not in st.session_state:
+    st.session_state["polygon_index"] = PolygonIndex()
+
 # ── Main area ───────────────────────────────────────────────────────────────
 bbox = {"latmin": lat_min, "latmax": lat_max, "lngmin": lng_min, "lngmax": lng_max}
 
@@ -130,11 +189,42 @@ if fetch_btn:
     taxa_list = [t.strip() for t in taxa_input.split(",") if t.strip()] if taxa_input else []
     polygons_only = len(taxa_list) == 0
 
+    # Occurrence page sizes, appended from the fetch's worker threads
+    pages = []
+    with st.spinner("Fetching formation polygons..." if polygons_only
+                    else "Fetching Macrostrat units, PBDB occurrences and map polygons..."):
+        page_status = st.empty()
+        # Identical queries from any session share one cached (or in-flight) result
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(
+                shared_query_cache().get_or_fetch,
+                query_key(bbox, taxa=taxa_list, interval_name=selected_interval_name,
+                          age_top=age_top, age_bottom=age_bottom, adaptive=adaptive_sampling),
+                lambda: fetch_compact(bbox, taxa=taxa_list, interval_name=selected_interval_name,
+                                      age_top=age_top, age_bottom=age_bottom,
+                                      adaptive=adaptive_sampling, on_page=pages.append),
+                # Results missing failed map lookups are not kept for other sessions
+                lambda fetched: not isinstance(fetched["polygons"], PartialResult),
+            )
+            while not wait([future], timeout=0.25).done:
+                if pages:
+                    page_status.caption(f"PaleobioDB: {sum(pages):,} occurrences received "
+                                        f"in {len(pages)} pages...")
+            fetched = future.result()
+        page_status.empty()
+    st.session_state["polygon_index"].update(fetched["polygon_index"])
+    tile_stats = get_tile_cache().stats()
+    st.caption(f"Tile cache: {tile_stats['hits']} hits, {tile_stats['misses']} misses")
+
     if polygons_only:
         # ── Polygons-only mode ─────────────────────────────────────────────
-        with st.spinner("Fetching formation polygons..."):
-            polygon_feats = fetch_map_polygons(bbox, age_top=age_top, age_bottom=age_bottom)
+        polygon_feats = fetched["polygons"]
         st.info(f"Macrostrat map: {len(polygon_feats)} unique polygons returned")
+        if isinstance(polygon_feats, PartialResult):
+            st.warning("Some map lookups failed, so polygons may be missing. Fetch again to retry them.")
+        cache_stats = get_map_cache().stats()
+        st.caption(f"Map cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                   f"{cache_stats['entries']} cached points")
 
         if not polygon_feats:
             st.warning("No polygons found. Try adjusting your region or age range.")
@@ -146,14 +236,10 @@ if fetch_btn:
 
     else:
         # ── Taxa mode (points + polygons) ──────────────────────────────────
-        with st.spinner("Fetching Macrostrat units..."):
-            units = fetch_units(bbox, interval_name=selected_interval_name,
-                                age_top=age_top, age_bottom=age_bottom)
+        units = fetched["units"]
         st.info(f"Macrostrat: {len(units)} units returned")
 
-        with st.spinner("Fetching PBDB occurrences..."):
-            occurrences = fetch_occurrences(bbox, taxa=taxa_list,
-                                            age_top=age_top, age_bottom=age_bottom)
+        occurrences = fetched["occurrences"]
         st.info(f"PaleobioDB: {len(occurrences)} occurrences returned")
 
         if not occurrences:
@@ -161,7 +247,8 @@ if fetch_btn:
             st.stop()
 
         with st.spinner("Correlating data..."):
-            groups = build_stage_unit_groups(occurrences, units)
+            # Groups hold index arrays into the occurrence store, not record lists
+            groups = compact_groups(occurrences, build_stage_unit_groups(occurrences, units))
 
         st.session_state["groups"] = groups
         st.session_state["occurrences"] = occurrences
@@ -183,31 +270,12 @@ if fetch_btn:
             fill=False,
         ).add_to(preview_map)
 
-        stage_colors = {}
-        palette = [
-            "#e6194b", "#3cb44b", "#ffe119", "#4363d8", "#f58231",
-            "#911eb4", "#42d4f4", "#f032e6", "#bfef45", "#fabed4",
-            "#469990", "#dcbeff", "#9A6324", "#800000", "#aaffc3",
-        ]
-        color_idx = 0
-        for (stage, _), occs in groups.items():
-            if stage not in stage_colors:
-                stage_colors[stage] = palette[color_idx % len(palette)]
-                color_idx += 1
-            color = stage_colors[stage]
-            for occ in occs:
-                lng = occ.get("lng")
-                lat = occ.get("lat")
-                if lng is None or lat is None:
-                    continue
-                folium.CircleMarker(
-                    location=[lat, lng],
-                    radius=4,
-                    color=color,
-                    fill=True,
-                    fill_opacity=0.7,
-                    popup=f"{occ.get('accepted_name', '?')}<br>{stage}",
-                ).add_to(preview_map)
+        mode, n_points, n_drawn = add_occurrences(
+            preview_map, groups, stage_colors(groups), requested=map_render_mode)
+        if mode == "grid":
+            st.caption(f"{n_points:,} occurrences binned into {n_drawn:,} per-stage grid cells")
+        elif mode == "cluster":
+            st.caption(f"{n_points:,} occurrences clustered in the browser")
 
         st_folium(preview_map, height=500, width=None, key="preview_map")
 
@@ -217,101 +285,161 @@ has_polys_only = st.session_state.get("polygon_feats")
 
 if has_groups or has_polys_only:
     st.divider()
-    if st.button("Export GeoJSON", type="secondary", width="stretch"):
+    export_format = st.selectbox(
+        "Export format", options=list(EXPORT_FORMATS),
+        format_func=lambda f: FORMAT_LABELS[f],
+        help="GeoParquet and FlatGeobuf are smaller and load faster in ArcGIS/QGIS; "
+             "FlatGeobuf includes a spatial index")
+    format_label = FORMAT_LABELS[export_format]
+    in_memory_export = st.checkbox(
+        "In-memory export (build the ZIP directly; nothing is written to `output/`)", value=False)
+    with st.expander("Polygon size reduction"):
+        simplify_tolerance = st.number_input(
+            "Simplification tolerance (degrees, 0 = off)", value=0.0, min_value=0.0,
+            max_value=1.0, step=0.001, format="%.4f",
+            help="Topology-preserving simplification; 0.001° is roughly 100 m")
+        coord_precision = st.selectbox(
+            "Coordinate precision", options=[None, 6, 5, 4, 3],
+            format_func=lambda p: "Full" if p is None else f"{p} decimals",
+            help="Round polygon coordinates; 5 decimals is roughly 1 m")
+    simplify_opts = {"tolerance": simplify_tolerance or None, "precision": coord_precision}
+    tile_archive = st.selectbox(
+        "Vector tiles", options=[None, ".mbtiles", ".pmtiles"],
+        format_func=lambda ext: {None: "None", ".mbtiles": "MBTiles", ".pmtiles": "PMTiles"}[ext],
+        help="Also tile all point and polygon groups into one archive for web maps")
+    size_stats = {}
+    if st.button("Export files", type="secondary", width="stretch"):
         output_dir = Path("output")
-        exported_files = []
+        archive = ExportArchive(file_format=export_format)
 
         if has_polys_only:
+            tile_points, tile_polygons = None, {("all", "formations"): has_polys_only}
             # Polygons-only export: single file with all polygons
             with st.spinner("Exporting polygons..."):
-                poly_path = export_polygon_geojson(
-                    has_polys_only, "all", "formations", bbox, output_dir=output_dir)
-                if poly_path:
-                    exported_files.append(poly_path)
+                if in_memory_export:
+                    archive.add_polygons(has_polys_only, "all", "formations", bbox,
+                                         stats=size_stats, **simplify_opts)
+                else:
+                    poly_path = export_polygon_geojson(
+                        has_polys_only, "all", "formations", bbox, output_dir=output_dir,
+                        stats=size_stats, file_format=export_format, **simplify_opts)
+                    if poly_path:
+                        archive.add_file(poly_path)
 
         else:
             groups = st.session_state["groups"]
 
             # Fetch formation polygons for all groups
             with st.spinner("Fetching formation polygons (this may take a minute)..."):
-                matched_polys = fetch_polygons_for_groups(groups)
+                matched_polys = fetch_polygons_for_groups(
+                    groups, polygon_index=st.session_state["polygon_index"])
+            tile_points, tile_polygons = groups, matched_polys
             total_polys = sum(len(v) for v in matched_polys.values())
             st.info(f"Formation polygons: {total_polys} polygons across {len(matched_polys)} groups")
+            cache_stats = get_map_cache().stats()
+            st.caption(f"Map cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                       f"{cache_stats['entries']} cached points")
+
+            point_paths = {}
+            if not in_memory_export:
+                with st.spinner("Exporting occurrence points..."):
+                    point_paths = export_all_geojson(
+                        groups, output_dir=output_dir, file_format=export_format)
 
-            progress = st.progress(0, text="Exporting GeoJSON files...")
+            progress = st.progress(0, text=f"Exporting {format_label} files...")
             total = len(groups)
-            for i, ((stage, unit_name), occs) in enumerate(sorted(groups.items())):
-                path = export_geojson(occs, stage, unit_name, output_dir=output_dir)
-                if path:
-                    exported_files.append(path)
+            for i, (stage, unit_name) in enumerate(sorted(groups)):
                 poly_feats = matched_polys.get((stage, unit_name), [])
-                if poly_feats:
-                    poly_path = export_polygon_geojson(
-                        poly_feats, stage, unit_name, bbox, output_dir=output_dir)
-                    if poly_path:
-                        exported_files.append(poly_path)
+                if in_memory_export:
+                    archive.add_points(groups[(stage, unit_name)], stage, unit_name)
+                    if poly_feats:
+                        archive.add_polygons(poly_feats, stage, unit_name, bbox,
+                                             stats=size_stats, **simplify_opts)
+                else:
+                    path = point_paths.get((stage, unit_name))
+                    if path:
+                        archive.add_file(path)
+                    if poly_feats:
+                        poly_path = export_polygon_geojson(
+                            poly_feats, stage, unit_name, bbox, output_dir=output_dir,
+                            stats=size_stats, file_format=export_format, **simplify_opts)
+                        if poly_path:
+                            archive.add_file(poly_path)
                 progress.progress((i + 1) / total)
             progress.empty()
 
-        st.success(f"Exported {len(exported_files)} GeoJSON files to `output/`")
+        archive.close()
+        if in_memory_export:
+            st.success(f"Exported {len(archive.names)} {format_label} files")
+        else:
+            st.success(f"Exported {len(archive.names)} {format_label} files to `output/`")
+        if size_stats:
+            st.caption(
+                f"Polygon files: {size_stats['bytes_before'] / 1024:,.0f} KB → "
+                f"{size_stats['bytes_after'] / 1024:,.0f} KB, {size_stats['vertices_before']:,} → "
+                f"{size_stats['vertices_after']:,} vertices"
+                + (f", {size_stats['features_dropped']} collapsed polygons dropped"
+                   if size_stats["features_dropped"] else ""))
+
+        if tile_archive:
+            tiles_name = f"geojsonify{tile_archive}"
+            with st.spinner("Building vector tiles..."):
+                if in_memory_export:
+                    with tempfile.TemporaryDirectory() as tmp:
+                        tiles_path = export_vector_tiles(
+                            tile_points, tile_polygons, bbox, Path(tmp) / tiles_name)
+                        tiles_data = tiles_path and tiles_path.read_bytes()
+                else:
+                    tiles_path = export_vector_tiles(
+                        tile_points, tile_polygons, bbox, output_dir / tiles_name)
+                    tiles_data = tiles_path and tiles_path.read_bytes
+            if tiles_data:
+                st.download_button(
+                    label=f"Download {tiles_name}",
+                    data=tiles_data,
+                    file_name=tiles_name,
+                    mime="application/octet-stream",
+                )
 
-        # Zip download
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-            for fp in exported_files:
-                zf.write(fp, fp.name)
-        zip_buffer.seek(0)
+        # Zip download; files are only read back from the archive when clicked
         st.download_button(
             label="Download all as ZIP",
-            data=zip_buffer,
+            data=archive.getvalue,
             file_name="macrostrat_geojson.zip",
             mime="application/zip",
         )
 
         # Individual file links
         st.subheader("Exported Files")
-        for fp in exported_files:
-            with open(fp, "r") as f:
-                st.download_button(
-                    label=fp.name,
-                    data=f.read(),
-                    file_name=fp.name,
-                    mime="application/geo+json",
-                    key=f"dl_{fp.name}",
-                )
+        for name in archive.names:
+            st.download_button(
+                label=name,
+                data=lambda name=name: archive.read(name),
+                file_name=name,
+                mime=EXPORT_FORMATS[export_format]["mime"],
+                key=f"dl_{name}",
+            )
 
 # ── Clear ─────────────────────────────────────────────────────────────────
 has_results = ("groups" in st.session_state or "polygon_feats" in st.session_state
-               or list(Path("output").glob("*.geojson")))
+               or exported_files(Path("output")))
 if has_results:
     st.divider()
     if st.button("Clear Results & Delete Output Files", type="secondary", width="stretch"):
-        for key in ("groups", "occurrences", "polygon_feats", "preview_file"):
+        for key in ("groups", "occurrences", "polygon_feats", "preview_file", "polygon_index"):
             st.session_state.pop(key, None)
         output_dir = Path("output")
         removed = 0
-        for f in output_dir.glob("*.geojson"):
+        for f in exported_files(output_dir):
             f.unlink()
             removed += 1
         st.success(f"Cleared results and deleted {removed} output files.")
         st.rerun()
 
 # ── GeoJSON Preview ───────────────────────────────────────────────────────
-output_dir = Path("output")
-geojson_files = sorted(output_dir.glob("*.geojson")) if output_dir.exists() else []
-
-# Show point files, polygon-only files (without a matching _points), and legacy files
-preview_options = []
-for f in geojson_files:
-    if f.stem.endswith("_points"):
-        preview_options.append(f)
-    elif f.stem.endswith("_polygons"):
-        # Include polygon files that have no matching points file
-        points_pair = f.with_name(f.stem.replace("_polygons", "_points") + ".geojson")
-        if not points_pair.exists():
-            preview_options.append(f)
-    else:
-        preview_options.append(f)
+# The listing and parsed layers (with bounds and center) are cached per file
+# path and only rebuilt when a file's mtime or size changes
+preview_options = preview_files(Path("output"))
 
 if preview_options:
     st.divider()
@@ -329,47 +457,26 @@ if preview_options:
 
     if "preview_file" in st.session_state:
         preview_path = Path(st.session_state["preview_file"])
-        if preview_path.exists():
-            with open(preview_path, "r") as f:
-                geojson_data = json.load(f)
+        preview_layer = get_preview_cache().get(preview_path)
+        if preview_layer is not None:
+            geojson_data = preview_layer["data"]
 
             is_points_file = preview_path.stem.endswith("_points")
             is_polygon_file = preview_path.stem.endswith("_polygons")
 
             # Find the matching polygon file for point files
             poly_path = None
+            poly_layer = None
             poly_data = None
             if is_points_file:
                 poly_path = preview_path.with_name(
                     preview_path.stem.replace("_points", "_polygons") + ".geojson"
                 )
-                if poly_path.exists():
-                    with open(poly_path, "r") as f:
-                        poly_data = json.load(f)
-
-            # Compute map center
-            lats, lngs = [], []
-            for feat in geojson_data.get("features", []):
-                geom = feat.get("geometry", {})
-                geom_type = geom.get("type", "")
-                coords = geom.get("coordinates")
-                if not coords:
-                    continue
-                if geom_type == "Point" and len(coords) >= 2:
-                    lngs.append(coords[0])
-                    lats.append(coords[1])
-                elif geom_type in ("Polygon", "MultiPolygon"):
-                    # Use centroid approximation from first coordinate ring
-                    ring = coords[0] if geom_type == "Polygon" else coords[0][0]
-                    if ring:
-                        lngs.extend(c[0] for c in ring)
-                        lats.extend(c[1] for c in ring)
-
-            if lats and lngs:
-                map_center = [sum(lats) / len(lats), sum(lngs) / len(lngs)]
-            else:
-                map_center = [center_lat, center_lng]
+                poly_layer = get_preview_cache().get(poly_path)
+                if poly_layer is not None:
+                    poly_data = poly_layer["data"]
 
+            map_center = preview_layer["center"] or [center_lat, center_lng]
             preview = folium.Map(location=map_center, zoom_start=6)
 
             # Render polygon data (either standalone or as companion to points)
@@ -413,12 +520,17 @@ if preview_options:
             caption_parts = []
             if is_polygon_file and not poly_data:
                 caption_parts.append(
-                    f"**{preview_path.name}** ({len(geojson_data.get('features', []))} polygons)")
+                    f"**{preview_path.name}** ({preview_layer['features']} polygons)")
             else:
                 caption_parts.append(
-                    f"**{preview_path.name}** ({len(geojson_data.get('features', []))} points)")
+                    f"**{preview_path.name}** ({preview_layer['features']} points)")
             if poly_data:
                 caption_parts.append(
-                    f"**{poly_path.name}** ({len(poly_data.get('features', []))} polygons)")
+                    f"**{poly_path.name}** ({poly_layer['features']} polygons)")
+            if any(layer and layer["simplified"] for layer in (preview_layer, poly_layer)):
+                caption_parts.append("polygons simplified for preview")
+            skipped = sum(layer["skipped"] for layer in (preview_layer, poly_layer) if layer)
+            if skipped:
+                caption_parts.append(f"{skipped} features with unreadable geometry skipped")
             st.caption("Previewing: " + " + ".join(caption_parts))
             st_folium(preview, height=500, width=None, key="geojson_preview_map")
@@ -2,7 +2,7 @@ import sqlite3
 import time
 from pathlib import Path
 
-import requests
+from api import client
 
 MACROSTRAT_INTERVALS_URL = "https://macrostrat.org/api/v2/defs/intervals"
 DEFAULT_DB_PATH = Path(__file__).resolve().parent.parent / "intervals.sqlite"
@@ -36,7 +36,7 @@ def init_db(db_path=None):
 
 
 def refresh_intervals(conn):
-    resp = requests.get(MACROSTRAT_INTERVALS_URL, params={"all": "", "format": "json"}, timeout=30)
+    resp = client.get(MACROSTRAT_INTERVALS_URL, params={"all": "", "format": "json"}, timeout=30)
     resp.raise_for_status()
     data = resp.json().get("success", {}).get("data", [])
     if not data:
@@ -0,0 +1,168 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_DB_PATH = Path(__file__).resolve().parent.parent / "map_cache.sqlite"
+CACHE_TTL_DAYS = 30
+CACHE_MAX_ENTRIES = 50_000
+COORD_PRECISION = 2
+# Access times are written in batches of this many hits, and expired and
+# excess rows are removed once every this many puts
+ACCESS_FLUSH_SIZE = 256
+EVICT_EVERY_PUTS = 100
+
+
+def quantize(lat, lng, precision=COORD_PRECISION):
+    return round(float(lat), precision), round(float(lng), precision)
+
+
+class MapPointCache:
+    """SQLite cache of Macrostrat map-at-point responses.
+
+    Entries are keyed by (lat, lng) rounded to ``precision`` decimal places,
+    expire after ``ttl_days`` and are evicted least-recently-used once the
+    table holds more than ``max_entries`` rows. A point row stores only the
+    map_ids of its polygons; each polygon is stored once in ``map_polygons``
+    and removed when no cached point refers to it, so neighbouring points do
+    not repeat the same geometry. Access times of hits are buffered and
+    written in batches, and expiry and eviction run every
+    ``EVICT_EVERY_PUTS`` puts, so neither costs a write per call. Safe to
+    share between threads.
+    """
+
+    def __init__(self, db_path=None, ttl_days=CACHE_TTL_DAYS, max_entries=CACHE_MAX_ENTRIES,
+                 precision=COORD_PRECISION):
+        self.db_path = db_path or DEFAULT_DB_PATH
+        self.ttl_seconds = ttl_days * 86400
+        self.max_entries = max_entries
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self._accessed = {}
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        # Caches written before polygons were shared kept whole feature lists per point
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(map_points)")]
+        if "features" in columns:
+            self._conn.execute("DROP TABLE map_points")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS map_points (
+                lat         REAL NOT NULL,
+                lng         REAL NOT NULL,
+                map_ids     TEXT NOT NULL,
+                fetched_at  REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (lat, lng)
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS map_polygons (
+                map_id  INTEGER PRIMARY KEY,
+                feature TEXT NOT NULL
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS map_points_accessed ON map_points (accessed_at)")
+        self._conn.commit()
+
+    def get(self, lat, lng):
+        """Return the cached feature list for a point, or None on a miss."""
+        key = quantize(lat, lng, self.precision)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT map_ids, fetched_at FROM map_points WHERE lat = ? AND lng = ?", key
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            entries = json.loads(row[0])
+            ids = [entry for entry in entries if not isinstance(entry, dict)]
+            polygons = {}
+            if ids:
+                polygons = dict(self._conn.execute(
+                    f"SELECT map_id, feature FROM map_polygons WHERE map_id IN ({', '.join('?' * len(ids))})",
+                    ids,
+                ).fetchall())
+                if len(polygons) < len(set(ids)):
+                    self.misses += 1
+                    return None
+            self._accessed[key] = now
+            if len(self._accessed) >= ACCESS_FLUSH_SIZE:
+                self._flush_accessed()
+                self._conn.commit()
+            self.hits += 1
+        # Features without a map_id are kept inline in the point's entry list
+        return [entry if isinstance(entry, dict) else json.loads(polygons[entry]) for entry in entries]
+
+    def put(self, lat, lng, features):
+        key = quantize(lat, lng, self.precision)
+        now = time.time()
+        entries = []
+        polygons = []
+        for feat in features:
+            map_id = feat.get("properties", {}).get("map_id")
+            if isinstance(map_id, int) and not isinstance(map_id, bool):
+                entries.append(map_id)
+                polygons.append((map_id, json.dumps(feat)))
+            else:
+                entries.append(feat)
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO map_polygons (map_id, feature) VALUES (?, ?)", polygons)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO map_points (lat, lng, map_ids, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (*key, json.dumps(entries), now, now),
+            )
+            self._accessed.pop(key, None)
+            self._puts += 1
+            if self._puts % EVICT_EVERY_PUTS == 0:
+                self._flush_accessed()
+                self._evict(now)
+            self._conn.commit()
+
+    def flush(self):
+        """Write buffered access times to the database."""
+        with self._lock:
+            self._flush_accessed()
+            self._conn.commit()
+
+    def _flush_accessed(self):
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE map_points SET accessed_at = ? WHERE lat = ? AND lng = ?",
+                [(accessed, *key) for key, accessed in self._accessed.items()])
+            self._accessed.clear()
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM map_points WHERE fetched_at < ?", (now - self.ttl_seconds,))
+        count = self._conn.execute("SELECT COUNT(*) FROM map_points").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM map_points WHERE rowid IN "
+                "(SELECT rowid FROM map_points ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+        self._conn.execute(
+            "DELETE FROM map_polygons WHERE map_id NOT IN "
+            "(SELECT ids.value FROM map_points, json_each(map_points.map_ids) AS ids "
+            "WHERE ids.type = 'integer')")
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM map_points")
+            self._conn.execute("DELETE FROM map_polygons")
+            self._conn.commit()
+            self._accessed.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM map_points").fetchone()[0]
+            polygons = self._conn.execute("SELECT COUNT(*) FROM map_polygons").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "polygons": polygons}
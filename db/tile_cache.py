@@ -0,0 +1,91 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_DB_PATH = Path(__file__).resolve().parent.parent / "tile_cache.sqlite"
+CACHE_TTL_HOURS = 24
+CACHE_MAX_ENTRIES = 5_000
+
+
+class TileCache:
+    """SQLite cache of per-tile query results.
+
+    Entries are keyed by a normalized query string (what was fetched and with
+    which taxa/age parameters) plus the tile's grid position and size. They
+    expire after ``ttl_hours`` and are evicted least-recently-used once the
+    table holds more than ``max_entries`` rows. Safe to share between threads.
+    """
+
+    def __init__(self, db_path=None, ttl_hours=CACHE_TTL_HOURS, max_entries=CACHE_MAX_ENTRIES):
+        self.db_path = db_path or DEFAULT_DB_PATH
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tiles (
+                query       TEXT NOT NULL,
+                tile_deg    REAL NOT NULL,
+                row         INTEGER NOT NULL,
+                col         INTEGER NOT NULL,
+                records     TEXT NOT NULL,
+                fetched_at  REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (query, tile_deg, row, col)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed_at)")
+        self._conn.commit()
+
+    def get(self, query, tile_deg, row, col):
+        """Return the cached records for a tile, or None on a miss."""
+        key = (query, tile_deg, row, col)
+        now = time.time()
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT records, fetched_at FROM tiles "
+                "WHERE query = ? AND tile_deg = ? AND row = ? AND col = ?", key
+            ).fetchone()
+            if found is None or now - found[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE tiles SET accessed_at = ? WHERE query = ? AND tile_deg = ? AND row = ? AND col = ?",
+                (now, *key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(found[0])
+
+    def put(self, query, tile_deg, row, col, records):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tiles (query, tile_deg, row, col, records, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (query, tile_deg, row, col, json.dumps(records), now, now),
+            )
+            self._conn.execute("DELETE FROM tiles WHERE fetched_at < ?", (now - self.ttl_seconds,))
+            count = self._conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM tiles WHERE rowid IN "
+                    "(SELECT rowid FROM tiles ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM tiles")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
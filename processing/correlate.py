@@ -1,4 +1,6 @@
+from bisect import bisect_left
 from collections import defaultdict
+from functools import lru_cache
 
 
 def assign_stage(occurrence):
@@ -11,71 +13,217 @@ def assign_stage(occurrence):
     return f"{early}\u2013{late}"
 
 
-def assign_unit(occurrence, macrostrat_units):
-    occ_fm = (occurrence.get("formation") or "").strip().lower()
-    occ_max = occurrence.get("max_ma")
-    occ_min = occurrence.get("min_ma")
+NGRAM = 3
+
+
+@lru_cache(maxsize=4096)
+def normalize_formation(name):
+    return (name or "").strip().lower()
+
 
-    best_match = None
-    best_score = -1
+def _ngrams(text):
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
 
-    for unit in macrostrat_units:
-        score = 0
 
-        # Temporal overlap check
-        u_top = unit.get("t_age")
-        u_bot = unit.get("b_age")
-        if occ_max is not None and occ_min is not None and u_top is not None and u_bot is not None:
-            overlap_top = max(occ_min, u_top)
-            overlap_bot = min(occ_max, u_bot)
-            if overlap_top >= overlap_bot:
+class UnitIndex:
+    """Age and formation-name index over Macrostrat units for occurrence matching.
+
+    Units are kept sorted by ``t_age`` together with the longest unit span, so
+    the units overlapping an occurrence's age range can be found with two
+    bisections instead of a scan over every unit. Candidates are returned in
+    their original order so scoring tie-breaks match a linear scan.
+
+    Normalized unit formation names are indexed by character trigram; the set
+    of units whose name contains a given occurrence formation is computed once
+    per distinct formation and then looked up.
+    """
+
+    def __init__(self, macrostrat_units):
+        self.units = list(macrostrat_units)
+        entries = []
+        for pos, unit in enumerate(self.units):
+            u_top = unit.get("t_age")
+            u_bot = unit.get("b_age")
+            # A unit with no age, or a zero/negative span, can never overlap
+            if u_top is None or u_bot is None or u_top >= u_bot:
                 continue
-            score += 1
-        else:
-            continue
+            entries.append((u_top, u_bot, pos))
+        entries.sort()
+        self._tops = [e[0] for e in entries]
+        self._bots = [e[1] for e in entries]
+        self._pos = [e[2] for e in entries]
+        self._max_span = max((bot - top for top, bot, _ in entries), default=0)
+
+        self._fm_positions = defaultdict(list)
+        for pos, unit in enumerate(self.units):
+            unit_fm = normalize_formation(unit.get("Fm") or unit.get("strat_name_long"))
+            if unit_fm:
+                self._fm_positions[unit_fm].append(pos)
+        self._fm_ngrams = defaultdict(set)
+        for unit_fm in self._fm_positions:
+            for gram in _ngrams(unit_fm):
+                self._fm_ngrams[gram].add(unit_fm)
+        self._fm_matches = {}
+
+    def overlapping_positions(self, occ_min, occ_max):
+        """Return positions of units whose age range strictly overlaps [occ_min, occ_max]."""
+        if occ_min is None or occ_max is None or occ_min >= occ_max:
+            return []
+        lo = bisect_left(self._tops, occ_min - self._max_span)
+        hi = bisect_left(self._tops, occ_max)
+        hits = [self._pos[i] for i in range(lo, hi) if self._bots[i] > occ_min]
+        hits.sort()
+        return hits
+
+    def overlapping(self, occ_min, occ_max):
+        """Return units whose age range strictly overlaps [occ_min, occ_max]."""
+        return [self.units[pos] for pos in self.overlapping_positions(occ_min, occ_max)]
 
-        # Formation name match
-        unit_fm = (unit.get("Fm") or unit.get("strat_name_long") or "").strip().lower()
-        if occ_fm and unit_fm and occ_fm in unit_fm:
-            score += 10
+    def formation_matches(self, occ_fm):
+        """Return positions of units whose formation name contains ``occ_fm``.
+
+        ``occ_fm`` must already be normalized.
+        """
+        if not occ_fm:
+            return frozenset()
+        matches = self._fm_matches.get(occ_fm)
+        if matches is None:
+            if len(occ_fm) >= NGRAM:
+                grams = sorted(_ngrams(occ_fm), key=lambda g: len(self._fm_ngrams.get(g, ())))
+                candidates = set(self._fm_ngrams.get(grams[0], ()))
+                for gram in grams[1:]:
+                    if not candidates:
+                        break
+                    candidates &= self._fm_ngrams.get(gram, set())
+            else:
+                candidates = self._fm_positions.keys()
+            matches = frozenset(pos for unit_fm in candidates if occ_fm in unit_fm
+                                for pos in self._fm_positions[unit_fm])
+            self._fm_matches[occ_fm] = matches
+        return matches
+
+
+def assign_unit(occurrence, macrostrat_units, index=None):
+    occ_fm = normalize_formation(occurrence.get("formation"))
+    occ_max = occurrence.get("max_ma")
+    occ_min = occurrence.get("min_ma")
 
-        if score > best_score:
-            best_score = score
-            best_match = unit
+    if index is None:
+        index = UnitIndex(macrostrat_units)
 
-    if best_match is None:
+    # Every candidate overlaps in time (1 point); a formation name match adds 10.
+    # The first name match is therefore the best possible score.
+    candidates = index.overlapping_positions(occ_min, occ_max)
+    if not candidates:
         return None
-    return best_match.get("strat_name_long") or best_match.get("unit_name") or str(best_match.get("unit_id", ""))
+    fm_matches = index.formation_matches(occ_fm)
+    best_pos = next((pos for pos in candidates if pos in fm_matches), candidates[0])
+    return _unit_label(index.units[best_pos])
+
+
+def _unit_label(unit):
+    return unit.get("strat_name_long") or unit.get("unit_name") or str(unit.get("unit_id", ""))
+
+
+def _assign_units_vectorized(occurrences, macrostrat_units, chunk_cells=4_000_000):
+    """Batch equivalent of calling assign_unit for every occurrence.
+
+    Ages are loaded into column arrays and each chunk of occurrences is scored
+    against all units at once; the best unit is the first column holding the
+    row maximum, which reproduces assign_unit's first-wins tie-break.
+    """
+    import numpy as np
+
+    labels = [None] * len(occurrences)
+    if not occurrences or not macrostrat_units:
+        return labels
+
+    def _age(value):
+        return np.nan if value is None else value
 
+    u_top = np.array([_age(u.get("t_age")) for u in macrostrat_units], dtype=float)
+    u_bot = np.array([_age(u.get("b_age")) for u in macrostrat_units], dtype=float)
+    o_min = np.array([_age(o.get("min_ma")) for o in occurrences], dtype=float)
+    o_max = np.array([_age(o.get("max_ma")) for o in occurrences], dtype=float)
 
-def build_stage_unit_groups(occurrences, macrostrat_units):
+    # Formation matches come from the name index, once per distinct formation
+    index = UnitIndex(macrostrat_units)
+    fm_codes = {}
+    o_fm = np.array([fm_codes.setdefault(normalize_formation(o.get("formation")), len(fm_codes))
+                     for o in occurrences], dtype=np.intp)
+    fm_match = np.zeros((len(fm_codes), len(macrostrat_units)), dtype=bool)
+    for occ_fm, code in fm_codes.items():
+        fm_match[code, list(index.formation_matches(occ_fm))] = True
+
+    unit_labels = [_unit_label(u) for u in macrostrat_units]
+    step = max(1, chunk_cells // len(macrostrat_units))
+    for start in range(0, len(occurrences), step):
+        stop = start + step
+        # NaN ages compare False, so units or occurrences without ages never overlap
+        overlap = (np.maximum(o_min[start:stop, None], u_top[None, :])
+                   < np.minimum(o_max[start:stop, None], u_bot[None, :]))
+        score = overlap * 1 + (overlap & fm_match[o_fm[start:stop]]) * 10
+        best = score.argmax(axis=1)
+        for row in np.flatnonzero(overlap.any(axis=1)):
+            labels[start + row] = unit_labels[best[row]]
+    return labels
+
+
+def build_stage_unit_groups(occurrences, macrostrat_units, engine="loop"):
+    """Group occurrences by (stage, unit_name).
+
+    occurrences may be any iterable, such as the generator returned by
+    api.paleobiodb.iter_occurrences; the loop engine consumes it one record
+    at a time.
+
+    engine: "loop" scores occurrences one at a time through assign_unit;
+    "vectorized" scores them in NumPy batches and returns the same mapping.
+    """
+    if engine == "vectorized":
+        occurrences = list(occurrences)
+        labels = _assign_units_vectorized(occurrences, macrostrat_units)
+        groups = defaultdict(list)
+        for occ, unit_name in zip(occurrences, labels):
+            groups[(assign_stage(occ), unit_name or "Unassigned")].append(occ)
+        return dict(groups)
+    if engine != "loop":
+        raise ValueError(f"Unknown correlation engine: {engine!r}")
+
+    index = UnitIndex(macrostrat_units)
     groups = defaultdict(list)
     for occ in occurrences:
         stage = assign_stage(occ)
-        unit_name = assign_unit(occ, macrostrat_units) or "Unassigned"
+        unit_name = assign_unit(occ, macrostrat_units, index=index) or "Unassigned"
         groups[(stage, unit_name)].append(occ)
     return dict(groups)
 
 
-def fetch_polygons_for_groups(groups, progress_callback=None):
+def fetch_polygons_for_groups(groups, progress_callback=None, max_workers=None, polygon_index=None):
     """Fetch map polygons by querying at unique occurrence locations per group.
 
-    For each group, samples up to ~20 unique occurrence locations and queries the
+    For each group, samples up to 5 unique occurrence locations and queries the
     Macrostrat map API to find the polygons that underlie those occurrences.
+    Point queries for all groups share one pool of ``max_workers`` threads;
+    groups are still processed, and progress reported, in order. Points that
+    ``polygon_index`` (a fresh index by default) can answer exactly from
+    responses it already holds are answered locally instead of queried.
 
     Returns a dict mapping (stage, unit_name) -> list of GeoJSON feature dicts,
     deduplicated by map_id within each group.
     """
-    from api.macrostrat import fetch_map_at_point
+    from api.macrostrat import MAP_MAX_WORKERS, PolygonIndex, fetch_map_at_points
+
+    if polygon_index is None:
+        polygon_index = PolygonIndex()
 
     matched = defaultdict(list)
     group_items = list(groups.items())
     total = len(group_items)
 
-    for idx, ((stage, unit_name), occs) in enumerate(group_items):
+    group_points = []
+    for (stage, unit_name), occs in group_items:
         if unit_name == "Unassigned":
-            if progress_callback:
-                progress_callback((idx + 1) / total)
+            group_points.append([])
             continue
 
         # Collect unique lat/lng pairs, sample up to 5
@@ -92,15 +240,23 @@ def fetch_polygons_for_groups(groups, progress_callback=None):
                 sample_points.append((lat, lng))
             if len(sample_points) >= 5:
                 break
+        group_points.append(sample_points)
 
+    results = fetch_map_at_points(
+        [pt for points in group_points for pt in points],
+        max_workers=max_workers or MAP_MAX_WORKERS,
+        polygon_index=polygon_index,
+    )
+    # Groups that share a map_id share one feature dict
+    features_by_id = {}
+    for idx, (((stage, unit_name), _), sample_points) in enumerate(zip(group_items, group_points)):
         seen_ids = set()
-        for lat, lng in sample_points:
-            feats = fetch_map_at_point(lat, lng)
-            for feat in feats:
+        for _ in sample_points:
+            for feat in next(results):
                 map_id = feat.get("properties", {}).get("map_id")
                 if map_id and map_id not in seen_ids:
                     seen_ids.add(map_id)
-                    matched[(stage, unit_name)].append(feat)
+                    matched[(stage, unit_name)].append(features_by_id.setdefault(map_id, feat))
 
         if progress_callback:
             progress_callback((idx + 1) / total)
@@ -1,9 +1,22 @@
+import io
 import re
+import threading
+from operator import itemgetter
 from pathlib import Path
 
-import geopandas as gpd
-from shapely.geometry import Point, box, shape
-from shapely.validation import make_valid
+try:
+    import geopandas as gpd
+    import numpy as np
+    import shapely
+    from shapely.geometry import Point, box, shape
+    from shapely.validation import make_valid
+except ImportError as exc:
+    # Slim deployments without GeoPandas/GDAL can still export points with
+    # backend="stream"; everything else fails loudly in _require_geopandas
+    gpd = None
+    _geopandas_error = exc
+
+from processing.geojson_stream import iter_point_features, point_field_types, write_point_features
 
 
 PROPERTIES = [
@@ -21,6 +34,22 @@ PROPERTIES = [
     "collection_no",
 ]
 
+# Output formats: file extension, GDAL driver (None: GeoDataFrame.to_parquet) and MIME type
+EXPORT_FORMATS = {
+    "geojson": {"extension": ".geojson", "driver": "GeoJSON", "mime": "application/geo+json"},
+    "geoparquet": {"extension": ".parquet", "driver": None,
+                   "mime": "application/vnd.apache.parquet"},
+    "flatgeobuf": {"extension": ".fgb", "driver": "FlatGeobuf",
+                   "mime": "application/octet-stream"},
+}
+
+
+def _require_geopandas():
+    if gpd is None:
+        raise ImportError(
+            "This export needs GeoPandas and Shapely; without them only GeoJSON points "
+            "can be written, with backend=\"stream\"") from _geopandas_error
+
 
 def _sanitize_filename(name):
     name = re.sub(r'[<>:"/\\|?*]', "_", name)
@@ -33,62 +62,313 @@ def _base_filename(stage, unit_name):
     return f"{_sanitize_filename(stage)}_{_sanitize_filename(unit_name)}"
 
 
-def export_geojson(occurrences, stage, unit_name, output_dir="output"):
-    output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
+def _extension(file_format):
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {file_format!r}")
+    return EXPORT_FORMATS[file_format]["extension"]
 
-    rows = []
-    for occ in occurrences:
-        lng = occ.get("lng")
-        lat = occ.get("lat")
-        if lng is None or lat is None:
-            continue
-        props = {}
-        for key in PROPERTIES:
-            val = occ.get(key)
-            if isinstance(val, (list, dict)):
-                val = str(val)
-            props[key] = val
-        props["stage"] = stage
-        props["unit_name"] = unit_name
-        rows.append({"geometry": Point(float(lng), float(lat)), **props})
 
+def output_name(stage, unit_name, kind, file_format="geojson"):
+    """Return the file name of a group's ``kind`` ("points" or "polygons") output."""
+    return f"{_base_filename(stage, unit_name)}_{kind}{_extension(file_format)}"
+
+
+def _arrow_safe(gdf):
+    """Return ``gdf`` with object columns as strings (nulls kept), since Arrow
+    rejects columns mixing types such as ints and strs."""
+    gdf = gdf.copy()
+    for col in gdf.columns:
+        if col != gdf.geometry.name and gdf[col].dtype == object:
+            gdf[col] = gdf[col].map(
+                lambda v: v if v is None or isinstance(v, str) else None if v != v else str(v))
+    return gdf
+
+
+def _write_frame(gdf, target, layer, file_format, **options):
+    """Write a GeoDataFrame to a path or binary buffer in one of EXPORT_FORMATS.
+
+    ``options`` are GDAL GeoJSON layer options and are ignored for other formats.
+    """
+    _require_geopandas()
+    driver = EXPORT_FORMATS[file_format]["driver"]
+    if driver is None:
+        # GeoParquet with WKB geometries and CRS metadata, zstd-compressed columns
+        _arrow_safe(gdf).to_parquet(target, compression="zstd")
+    elif driver == "GeoJSON":
+        gdf.to_file(target, driver=driver, layer=layer, **options)
+    else:
+        # FlatGeobuf writes its packed Hilbert R-tree index by default
+        gdf.to_file(target, driver=driver, layer=layer)
+
+
+def _open_target(target):
+    return open(target, "wb") if isinstance(target, (str, Path)) else target()
+
+
+def _write_target(gdf, target, layer, file_format, **options):
+    """Write a frame to a path or an opener (see write_points); returns the bytes written."""
+    if isinstance(target, (str, Path)):
+        _write_frame(gdf, str(target), layer, file_format, **options)
+        return Path(target).stat().st_size
+    # GDAL and Arrow only write to paths or their own buffers, so the file is
+    # built once in memory and then copied through
+    buf = io.BytesIO()
+    _write_frame(gdf, buf, layer, file_format, **options)
+    data = buf.getbuffer()
+    with target() as fp:
+        fp.write(data)
+    return data.nbytes
+
+
+def point_frame(features):
+    """Build a point GeoDataFrame from iter_point_features output, or None if empty."""
+    _require_geopandas()
+    rows = [{"geometry": Point(lng, lat), **props} for props, lng, lat in features]
     if not rows:
         return None
+    return gpd.GeoDataFrame(rows, crs="EPSG:4326")
+
+
+def write_points(occurrences, stage, unit_name, target, file_format="geojson",
+                 backend="geopandas"):
+    """Write a stage×unit group's occurrences as a Point file to ``target``.
+
+    target: a path, or a callable returning a writable binary file, which is
+    called only once there is something to write.
+    backend: "geopandas" writes through a GeoDataFrame and GDAL; "stream"
+    writes features one at a time with the dependency-free writer in
+    processing.geojson_stream, after a first pass over ``occurrences`` to
+    type the columns, and produces the same file.
+    file_format: a key of EXPORT_FORMATS. The stream backend writes GeoJSON only.
+    Returns False if no occurrence has coordinates, True otherwise.
+    """
+    layer = Path(output_name(stage, unit_name, "points", file_format)).stem
+    features = iter_point_features(occurrences, stage, unit_name, PROPERTIES)
+    if backend == "stream":
+        if file_format != "geojson":
+            raise ValueError("The stream backend only writes GeoJSON")
+        # A first pass types the columns, so the output matches GDAL's
+        field_types = point_field_types(features)
+        if not field_types:
+            return False
+        with _open_target(target) as fp:
+            write_point_features(fp, layer,
+                                 iter_point_features(occurrences, stage, unit_name, PROPERTIES),
+                                 field_types)
+        return True
+    if backend != "geopandas":
+        raise ValueError(f"Unknown export backend: {backend!r}")
+
+    gdf = point_frame(features)
+    if gdf is None:
+        return False
+    _write_target(gdf, target, layer, file_format)
+    return True
 
-    gdf = gpd.GeoDataFrame(rows, crs="EPSG:4326")
-    filename = f"{_base_filename(stage, unit_name)}_points.geojson"
-    out_path = output_dir / filename
-    gdf.to_file(str(out_path), driver="GeoJSON")
+
+def export_geojson(occurrences, stage, unit_name, output_dir="output", backend="geopandas",
+                   file_format="geojson"):
+    """Export a stage×unit group's occurrences as a Point file (GeoJSON by default).
+
+    backend and file_format work as in write_points; only the same file stem
+    with that format's extension is written.
+    Returns the output Path, or None if no occurrence has coordinates.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    out_path = output_dir / output_name(stage, unit_name, "points", file_format)
+    if not write_points(occurrences, stage, unit_name, out_path, file_format, backend):
+        return None
     return out_path
 
 
-def export_polygon_geojson(polygon_features, stage, unit_name, bbox, output_dir="output"):
-    """Export polygon features for a stage×unit group, clipped to the bounding box.
+def export_all_geojson(groups, output_dir="output", backend="geopandas", file_format="geojson"):
+    """Export every stage×unit group's points in one pass.
 
-    polygon_features: list of GeoJSON feature dicts from the Macrostrat map API.
-    bbox: dict with latmin, latmax, lngmin, lngmax.
-    Returns the output Path, or None if no valid polygons.
+    Builds the property columns and point geometries (via points_from_xy) for
+    all occurrences at once, then writes each group's file from slices of
+    those columns. Each file matches what export_geojson writes for the group.
+    With backend="stream" each group is written by the streaming writer instead.
+    file_format: a key of EXPORT_FORMATS, as in export_geojson.
+    Returns a dict mapping (stage, unit_name) -> output Path for non-empty groups.
     """
+    if backend == "stream":
+        paths = {}
+        for (stage, unit_name), occs in groups.items():
+            path = export_geojson(occs, stage, unit_name, output_dir=output_dir, backend="stream",
+                                  file_format=file_format)
+            if path:
+                paths[(stage, unit_name)] = path
+        return paths
+
+    _require_geopandas()
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    clip_box = box(bbox["lngmin"], bbox["latmin"], bbox["lngmax"], bbox["latmax"])
+    columns = {key: [] for key in PROPERTIES}
+    columns["stage"] = []
+    columns["unit_name"] = []
+    lngs, lats, group_rows = [], [], []
+    for (stage, unit_name), occs in groups.items():
+        rows = []
+        for occ in occs:
+            lng = occ.get("lng")
+            lat = occ.get("lat")
+            if lng is None or lat is None:
+                continue
+            rows.append(len(lngs))
+            lngs.append(float(lng))
+            lats.append(float(lat))
+            for key in PROPERTIES:
+                val = occ.get(key)
+                if isinstance(val, (list, dict)):
+                    val = str(val)
+                columns[key].append(val)
+            columns["stage"].append(stage)
+            columns["unit_name"].append(unit_name)
+        group_rows.append(((stage, unit_name), rows))
 
-    rows = []
-    for feat in polygon_features:
-        try:
-            geom = shape(feat["geometry"])
-            if not geom.is_valid:
-                geom = make_valid(geom)
-        except Exception:
+    points = gpd.points_from_xy(lngs, lats)
+    paths = {}
+    for (stage, unit_name), rows in group_rows:
+        if not rows:
             continue
+        # Column values are sliced as lists so each group's dtypes are
+        # inferred exactly as export_geojson infers them
+        take = itemgetter(*rows) if len(rows) > 1 else (lambda col, i=rows[0]: (col[i],))
+        data = {"geometry": points[np.asarray(rows)]}
+        data.update((key, list(take(values))) for key, values in columns.items())
+        gdf = gpd.GeoDataFrame(data, crs="EPSG:4326")
+        out_path = output_dir / output_name(stage, unit_name, "points", file_format)
+        _write_frame(gdf, str(out_path), out_path.stem, file_format)
+        paths[(stage, unit_name)] = out_path
+    return paths
+
+
+def _clip_one(geometry, clip_box):
+    """Parse, repair and clip one GeoJSON geometry; None if it is broken or falls outside."""
+    try:
+        geom = shape(geometry)
+        if not geom.is_valid:
+            geom = make_valid(geom)
+    except Exception:
+        return None
 
+    try:
+        clipped = geom.intersection(clip_box)
+    except Exception:
+        return None
+    if clipped.is_empty:
+        return None
+    return clipped
+
+
+def parse_polygon(geometry):
+    """Build a (Multi)Polygon from a GeoJSON dict via NumPy coordinate arrays.
+
+    Much faster than shape() for rings with many vertices; anything else is
+    handed to shape().
+    """
+    _require_geopandas()
+    gtype = geometry.get("type")
+    try:
+        if gtype == "Polygon":
+            rings = [np.asarray(ring, dtype=float) for ring in geometry["coordinates"]]
+            return shapely.polygons(rings[0], holes=rings[1:] or None)
+        if gtype == "MultiPolygon":
+            parts = []
+            for poly in geometry["coordinates"]:
+                rings = [np.asarray(ring, dtype=float) for ring in poly]
+                parts.append(shapely.polygons(rings[0], holes=rings[1:] or None))
+            return shapely.multipolygons(parts)
+    except Exception:
+        pass
+    return shape(geometry)
+
+
+def _clip_batch(geometries, bbox):
+    """Vectorized _clip_one over a list of GeoJSON geometries.
+
+    Geometries are repaired and clipped with shapely array functions.
+    Geometries whose bounds lie inside the box are kept as-is, the rest are
+    cut with clip_by_rect, falling back to an exact intersection where that
+    gives an invalid result. Geometries that fail to parse go through
+    _clip_one individually, and if a later step fails for the batch every
+    feature does, so broken geometries are handled as before.
+    """
+    clip_box = box(bbox["lngmin"], bbox["latmin"], bbox["lngmax"], bbox["latmax"])
+    empty = shapely.from_wkt("GEOMETRYCOLLECTION EMPTY")
+    parsed, missing = [], []
+    for geometry in geometries:
+        # The map API hands us dicts; building them from coordinate arrays is
+        # faster than shape() or a serialize-and-parse round trip through from_geojson
         try:
-            clipped = geom.intersection(clip_box)
+            parsed.append(parse_polygon(geometry))
+            missing.append(False)
         except Exception:
-            continue
-        if clipped.is_empty:
+            parsed.append(empty)
+            missing.append(True)
+    try:
+        geoms = np.array(parsed, dtype=object)
+        invalid = ~shapely.is_valid(geoms)
+        if invalid.any():
+            geoms[invalid] = shapely.make_valid(geoms[invalid])
+
+        xmin, ymin, xmax, ymax = shapely.bounds(geoms).T
+        inside = ((xmin >= bbox["lngmin"]) & (xmax <= bbox["lngmax"])
+                  & (ymin >= bbox["latmin"]) & (ymax <= bbox["latmax"]))
+        clipped = geoms.copy()
+        cut = ~inside
+        if cut.any():
+            clipped[cut] = shapely.clip_by_rect(
+                geoms[cut], bbox["lngmin"], bbox["latmin"], bbox["lngmax"], bbox["latmax"])
+            dirty = cut & ~shapely.is_valid(clipped)
+            if dirty.any():
+                clipped[dirty] = shapely.intersection(geoms[dirty], clip_box)
+    except Exception:
+        return [_clip_one(g, clip_box) for g in geometries]
+    return [_clip_one(geometry, clip_box) if miss else None if geom.is_empty else geom
+            for geometry, geom, miss in zip(geometries, clipped, missing)]
+
+
+_geometry_store = None
+_geometry_store_lock = threading.Lock()
+
+
+def get_geometry_store():
+    """Return the process-wide store of processed polygon geometries, creating it on first use."""
+    global _geometry_store
+    if _geometry_store is None:
+        with _geometry_store_lock:
+            if _geometry_store is None:
+                from processing.geometry_store import GeometryStore
+                _geometry_store = GeometryStore()
+    return _geometry_store
+
+
+def polygon_frame(polygon_features, stage, unit_name, bbox, store=None):
+    """Build the clipped GeoDataFrame for a group's polygons, or None if none survive.
+
+    Geometries already processed for this bbox are taken from ``store`` (the
+    shared geometry store by default) by map_id; the rest are clipped in one
+    batch and added to it.
+    """
+    _require_geopandas()
+    polygon_features = list(polygon_features)
+    if store is None:
+        store = get_geometry_store()
+    map_ids = [feat.get("properties", {}).get("map_id") for feat in polygon_features]
+    known = store.get_many([map_id for map_id in map_ids if map_id], bbox)
+    todo = [i for i, map_id in enumerate(map_ids) if not map_id or map_id not in known]
+    clipped = [known.get(map_id) for map_id in map_ids]
+    for i, geom in zip(todo, _clip_batch([polygon_features[i].get("geometry") for i in todo], bbox)):
+        clipped[i] = geom
+        if map_ids[i]:
+            store.put(map_ids[i], bbox, geom)
+
+    rows = []
+    for feat, geom in zip(polygon_features, clipped):
+        if geom is None:
             continue
 
         props = {}
@@ -100,13 +380,103 @@ def export_polygon_geojson(polygon_features, stage, unit_name, bbox, output_dir=
             props[key] = val
         props["stage"] = stage
         props["unit_name"] = unit_name
-        rows.append({"geometry": clipped, **props})
+        rows.append({"geometry": geom, **props})
 
     if not rows:
         return None
+    return gpd.GeoDataFrame(rows, crs="EPSG:4326")
+
 
-    gdf = gpd.GeoDataFrame(rows, crs="EPSG:4326")
-    filename = f"{_base_filename(stage, unit_name)}_polygons.geojson"
-    out_path = output_dir / filename
-    gdf.to_file(str(out_path), driver="GeoJSON")
+def simplify_polygons(gdf, tolerance=None, precision=None):
+    """Simplify and round a polygon GeoDataFrame's geometries to shrink the output.
+
+    tolerance: simplification tolerance in degrees. Simplification preserves
+    topology, so rings stay valid and holes stay inside their shells.
+    precision: decimal places to snap coordinates to (set_precision keeps the
+    result valid). Rows whose geometry collapses to empty are dropped.
+    Returns (gdf, stats) with vertex counts before and after.
+    """
+    _require_geopandas()
+    geoms = np.asarray(gdf.geometry.array, dtype=object)
+    vertices_before = int(shapely.get_num_coordinates(geoms).sum())
+    if tolerance:
+        geoms = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    if precision is not None:
+        geoms = shapely.set_precision(geoms, 10.0 ** -precision)
+    keep = ~shapely.is_empty(geoms)
+    gdf = gdf[keep].set_geometry(geoms[keep], crs=gdf.crs)
+    return gdf, {"vertices_before": vertices_before,
+                 "vertices_after": int(shapely.get_num_coordinates(geoms[keep]).sum()),
+                 "features_dropped": int((~keep).sum())}
+
+
+def _simplified_frame(gdf, tolerance, precision):
+    """Apply simplify_polygons if asked, returning (gdf, write options, frame stats)."""
+    if not tolerance and precision is None:
+        return gdf, {}, None
+    gdf, frame_stats = simplify_polygons(gdf, tolerance, precision)
+    # Keep GDAL's GeoJSON driver from writing 15 decimals for snapped coordinates
+    options = {} if precision is None else {"COORDINATE_PRECISION": precision}
+    return gdf, options, frame_stats
+
+
+def _frame_size(gdf, layer, file_format):
+    buf = io.BytesIO()
+    _write_frame(gdf, buf, layer, file_format)
+    return buf.getbuffer().nbytes
+
+
+def _add_size_stats(stats, frame_stats, bytes_before, bytes_after):
+    """Accumulate one file's vertex counts and sizes before/after simplification."""
+    for key, value in (("files", 1),
+                       ("vertices_before", frame_stats["vertices_before"]),
+                       ("vertices_after", frame_stats["vertices_after"]),
+                       ("bytes_before", bytes_before),
+                       ("bytes_after", bytes_after),
+                       ("features_dropped", frame_stats["features_dropped"])):
+        stats[key] = stats.get(key, 0) + value
+
+
+def write_polygons(polygon_features, stage, unit_name, bbox, target, tolerance=None,
+                   precision=None, stats=None, file_format="geojson"):
+    """Write a stage×unit group's polygons, clipped to the bounding box, to ``target``.
+
+    polygon_features: list of GeoJSON feature dicts from the Macrostrat map API.
+    bbox: dict with latmin, latmax, lngmin, lngmax.
+    target: a path or an opener, as in write_points.
+    tolerance/precision: optional topology-preserving simplification (degrees)
+    and coordinate rounding (decimal places), see simplify_polygons.
+    stats: optional dict that vertex counts and file sizes before/after
+    simplification are added to (the size before is measured by also
+    writing the unsimplified polygons to memory).
+    file_format: a key of EXPORT_FORMATS.
+    Returns False if no valid polygons, True otherwise.
+    """
+    layer = Path(output_name(stage, unit_name, "polygons", file_format)).stem
+    gdf = polygon_frame(polygon_features, stage, unit_name, bbox)
+    if gdf is None:
+        return False
+    out_gdf, options, frame_stats = _simplified_frame(gdf, tolerance, precision)
+    if out_gdf.empty:
+        return False
+
+    size = _write_target(out_gdf, target, layer, file_format, **options)
+    if stats is not None and frame_stats is not None:
+        _add_size_stats(stats, frame_stats, _frame_size(gdf, layer, file_format), size)
+    return True
+
+
+def export_polygon_geojson(polygon_features, stage, unit_name, bbox, output_dir="output",
+                           tolerance=None, precision=None, stats=None, file_format="geojson"):
+    """Export polygon features for a stage×unit group, clipped to the bounding box.
+
+    The arguments work as in write_polygons.
+    Returns the output Path, or None if no valid polygons.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    out_path = output_dir / output_name(stage, unit_name, "polygons", file_format)
+    if not write_polygons(polygon_features, stage, unit_name, bbox, out_path, tolerance,
+                          precision, stats, file_format):
+        return None
     return out_path
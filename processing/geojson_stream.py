@@ -0,0 +1,253 @@
+import ast
+import json
+import math
+from json.encoder import encode_basestring
+
+# Same header GDAL's GeoJSON driver writes for EPSG:4326, which ArcGIS expects
+CRS84 = '{ "type": "name", "properties": { "name": "urn:ogc:def:crs:OGC:1.3:CRS84" } }'
+
+
+def _json_value(val):
+    if val is None:
+        return "null"
+    if isinstance(val, str):
+        return encode_basestring(val)
+    if isinstance(val, float) and not math.isfinite(val):
+        return "null"
+    return json.dumps(val, ensure_ascii=False)
+
+
+def _format_real(val):
+    """Format a float property like GDAL: the shortest of %.17g..%.14g without a
+    roundoff run of 0s or 9s after the point, and always with a point or exponent."""
+    text = "%.17g" % val
+    frac = text.partition(".")[2]
+    if "999999" in frac or "000000" in frac:
+        for digits in (16, 15, 14):
+            candidate = "%.*g" % (digits, val)
+            frac = candidate.partition(".")[2]
+            if "." in candidate and "999999" not in frac and "000000" not in frac:
+                text = candidate
+                break
+    if "." not in text and "e" not in text:
+        text += ".0"
+    return text
+
+
+def _round_up(text):
+    """Add one unit in the last place of a decimal string."""
+    digits = list(text)
+    for i in range(len(digits) - 1, -1, -1):
+        if digits[i] == ".":
+            continue
+        if digits[i] == "-":
+            break
+        if digits[i] != "9":
+            digits[i] = str(int(digits[i]) + 1)
+            return "".join(digits)
+        digits[i] = "0"
+    digits.insert(1 if digits[0] == "-" else 0, "1")
+    return "".join(digits)
+
+
+def _intelliround(text):
+    """Drop a trailing run of 0s or 9s left by %.15f roundoff, as GDAL does."""
+    n = len(text)
+    if n <= 10 or "." not in text or "e" in text:
+        return text
+    tail = text[-9:-1]
+    if "00" not in tail and "99" not in tail:
+        return text
+    dot = text.index(".")
+    before = dot - 1 - (text[0] == "-")
+
+    def _run(digit):
+        return (dot < n - 8 and all(before >= k + 1 or text[n - k] == digit for k in range(3, 8))
+                and text[n - 8] == digit and text[n - 9] == digit)
+
+    if text[n - 6:n - 1] == "00000":
+        return text[:-1]
+    if _run("0"):
+        return text[:-8]
+    if text[n - 6:n - 1] == "99999":
+        return _round_up(text[:-6])
+    if dot < n - 9 and _run("9"):
+        return _round_up(text[:-9])
+    return text
+
+
+def _format_coord(val):
+    """Format a coordinate like GDAL's GeoJSON driver (15 decimals, trailing zeros trimmed)."""
+    if abs(val) > 1e50:
+        return "%.17g" % val
+    text = _intelliround("%.15f" % val)
+    if "." in text:
+        text = text.rstrip("0")
+        if text.endswith("."):
+            text += "0"
+    return text
+
+
+def point_field_types(features):
+    """Return the field type GDAL gets for each property of iter_point_features output.
+
+    Mirrors how a GeoDataFrame types the columns: "integer" for ints only,
+    "real" for numbers mixing floats, or ints with nulls, "boolean" for bools
+    only, None for all-null columns and "string" for anything else.
+    """
+    # Rows share few distinct (keys, value types) signatures, so collect those
+    signatures = set()
+    for props, _, _ in features:
+        signatures.add((tuple(props), tuple(map(type, props.values()))))
+    kinds = {}
+    for keys, value_types in signatures:
+        for key, value_type in zip(keys, value_types):
+            kinds.setdefault(key, set()).add(value_type)
+    types = {}
+    for key, found in kinds.items():
+        values = found - {type(None)}
+        if not values:
+            types[key] = None
+        elif values == {bool} and values == found:
+            types[key] = "boolean"
+        elif values == {int} and values == found:
+            types[key] = "integer"
+        elif values <= {int, float}:
+            types[key] = "real"
+        else:
+            types[key] = "string"
+    return types
+
+
+class _RawNumber(str):
+    """A JSON number kept as its source text, which GDAL writes back unchanged."""
+
+
+def _nested_json(val, allow_null):
+    """Encode a parsed list/dict the way GDAL re-emits it, or None if GDAL couldn't parse it."""
+    if val is None:
+        return "null" if allow_null else None
+    if isinstance(val, _RawNumber):
+        return str(val)
+    if isinstance(val, bool):
+        return "true" if val else "false"
+    if isinstance(val, int):
+        return str(val)
+    if isinstance(val, float):
+        return "NaN" if math.isnan(val) else repr(val) if math.isfinite(val) else None
+    if isinstance(val, str):
+        return json.dumps(val, ensure_ascii=False)
+    if isinstance(val, list):
+        items = [_nested_json(item, allow_null) for item in val]
+        if None in items:
+            return None
+        return f"[ {', '.join(items)} ]" if items else "[ ]"
+    if isinstance(val, dict):
+        if not all(isinstance(k, str) for k in val):
+            return None
+        items = [(json.dumps(k, ensure_ascii=False), _nested_json(v, allow_null))
+                 for k, v in val.items()]
+        if any(v is None for _, v in items):
+            return None
+        return f"{{ {', '.join(f'{k}: {v}' for k, v in items)} }}" if items else "{ }"
+    return None
+
+
+def _string_value(text):
+    """Encode a string property. GDAL writes a string holding a JSON array or
+    object as that array or object, and its lenient parser also reads the
+    Python repr that iter_point_features makes of list and dict values."""
+    if text[:1] + text[-1:] in ("[]", "{}"):
+        try:
+            encoded = _nested_json(json.loads(text, parse_float=_RawNumber,
+                                              parse_constant=_RawNumber), True)
+        except (ValueError, RecursionError):
+            encoded = None
+        if encoded is None and "\\x" not in text and "\\'" not in text:
+            # Python's repr: single-quoted strings and True/False, but None is
+            # not a JSON literal
+            try:
+                encoded = _nested_json(ast.literal_eval(text), False)
+            except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+                encoded = None
+        if encoded is not None and encoded[0] in "[{":
+            return encoded
+    return encode_basestring(text)
+
+
+def _real_value(val):
+    if val is None or not math.isfinite(val):
+        return "null"
+    return _format_real(float(val))
+
+
+def _str_value(val):
+    # val != val: NaN
+    return "null" if val is None or val != val else _string_value(str(val))
+
+
+_FIELD_ENCODERS = {
+    "integer": str,
+    "boolean": lambda val: "true" if val else "false",
+    "real": _real_value,
+    "string": _str_value,
+}
+
+
+def iter_point_features(occurrences, stage, unit_name, keys):
+    """Yield (properties, lng, lat) for each occurrence that has coordinates.
+
+    Properties are flattened exactly like export_geojson: list and dict values
+    become strings, and ``stage``/``unit_name`` are appended.
+    """
+    for occ in occurrences:
+        lng = occ.get("lng")
+        lat = occ.get("lat")
+        if lng is None or lat is None:
+            continue
+        props = {}
+        for key in keys:
+            val = occ.get(key)
+            if isinstance(val, (list, dict)):
+                val = str(val)
+            props[key] = val
+        props["stage"] = stage
+        props["unit_name"] = unit_name
+        yield props, float(lng), float(lat)
+
+
+def write_point_features(fp, name, features, field_types=None):
+    """Stream a Point FeatureCollection to the binary file object ``fp``.
+
+    ``features`` is an iterable of (properties, lng, lat). Features are
+    encoded and written one at a time in the layout and number formatting
+    GDAL's GeoJSON driver uses, so memory use does not grow with the number
+    of features. ``field_types`` (from point_field_types over the same
+    features) coerces each column to one type the way GDAL does; without it
+    values keep their own JSON types. Returns the number of features written.
+    """
+    fp.write(("{\n"
+              '"type": "FeatureCollection",\n'
+              f'"name": {_json_value(name)},\n'
+              f'"crs": {CRS84},\n'
+              '"features": [\n').encode("utf-8"))
+    # Encoded "key: " prefix and value encoder per property
+    columns = {}
+    count = 0
+    for props, lng, lat in features:
+        parts = []
+        for key, val in props.items():
+            column = columns.get(key)
+            if column is None:
+                encoder = _json_value if field_types is None else _FIELD_ENCODERS.get(
+                    field_types.get(key), _json_value)
+                column = columns[key] = (_json_value(key) + ": ", encoder)
+            parts.append(column[0] + column[1](val))
+        body = ", ".join(parts)
+        line = ('{ "type": "Feature", "properties": { ' + body + ' }, '
+                f'"geometry": {{ "type": "Point", "coordinates": '
+                f'[ {_format_coord(lng)}, {_format_coord(lat)} ] }} }}')
+        fp.write(((",\n" if count else "") + line).encode("utf-8"))
+        count += 1
+    fp.write(("\n" if count else "").encode("utf-8") + b"]\n}\n")
+    return count
@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+import shapely
+
+STORE_MAX_COORDS = 5_000_000
+
+
+def bbox_key(bbox):
+    return (bbox["lngmin"], bbox["latmin"], bbox["lngmax"], bbox["latmax"])
+
+
+class GeometryStore:
+    """Processed map polygon geometries keyed by (map_id, bbox).
+
+    Holds the parsed, repaired and clipped geometry for each polygon (or None
+    when it was broken or fell outside the bbox) so every group and export
+    using the same map_id reuses one result. Entries are evicted
+    least-recently-used once they hold more than ``max_coords`` coordinates.
+    Safe to share between threads.
+    """
+
+    def __init__(self, max_coords=STORE_MAX_COORDS):
+        self.max_coords = max_coords
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._coords = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, map_ids, bbox):
+        """Return {map_id: geometry} for the ids already stored for ``bbox``."""
+        key = bbox_key(bbox)
+        found = {}
+        with self._lock:
+            for map_id in map_ids:
+                entry = self._entries.get((map_id, key))
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end((map_id, key))
+                self.hits += 1
+                found[map_id] = entry[0]
+        return found
+
+    def put(self, map_id, bbox, geometry):
+        size = 1 if geometry is None else int(shapely.get_num_coordinates(geometry)) + 1
+        with self._lock:
+            old = self._entries.pop((map_id, bbox_key(bbox)), None)
+            if old is not None:
+                self._coords -= old[1]
+            self._entries[(map_id, bbox_key(bbox))] = (geometry, size)
+            self._coords += size
+            while self._entries and self._coords > self.max_coords:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._coords -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._coords = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries), "coords": self._coords}
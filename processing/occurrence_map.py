@@ -0,0 +1,143 @@
+import math
+
+import folium
+import numpy as np
+from folium.plugins import FastMarkerCluster
+
+# Rendering limits; each mode's HTML size is roughly bounded by its limit
+# (about 1 KB per marker or bin, about 50 bytes per clustered point)
+MARKER_LIMIT = 1000
+CLUSTER_MAX_POINTS = 30000
+GRID_MAX_BINS = 1500
+GRID_MAX_CELLS = 1024
+
+STAGE_PALETTE = [
+    "#e6194b", "#3cb44b", "#ffe119", "#4363d8", "#f58231",
+    "#911eb4", "#42d4f4", "#f032e6", "#bfef45", "#fabed4",
+    "#469990", "#dcbeff", "#9A6324", "#800000", "#aaffc3",
+]
+
+# Builds one colored circle marker per row of [lat, lng, color, popup]
+_CLUSTER_CALLBACK = """\
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]),
+        {radius: 4, color: row[2], fill: true, fillOpacity: 0.7});
+    marker.bindPopup(row[3]);
+    return marker;
+};"""
+
+
+def stage_colors(groups, palette=STAGE_PALETTE):
+    """Assign palette colors to stages in the order they first appear in ``groups``."""
+    colors = {}
+    for stage, _ in groups:
+        if stage not in colors:
+            colors[stage] = palette[len(colors) % len(palette)]
+    return colors
+
+
+def _points(groups):
+    """Return (lats, lngs, stages, names) for every occurrence with coordinates."""
+    lats, lngs, stages, names = [], [], [], []
+    for (stage, _), occs in groups.items():
+        for occ in occs:
+            lng = occ.get("lng")
+            lat = occ.get("lat")
+            if lng is None or lat is None:
+                continue
+            lats.append(float(lat))
+            lngs.append(float(lng))
+            stages.append(stage)
+            names.append(occ.get("accepted_name", "?"))
+    return lats, lngs, stages, names
+
+
+def grid_bins(lats, lngs, stages, max_bins=GRID_MAX_BINS):
+    """Bin points per stage on the finest square grid giving at most ``max_bins`` bins.
+
+    The grid spans the points' extent and is refined in steps of 1.5x while
+    the number of occupied (stage, cell) bins stays within ``max_bins``. Returns
+    a list of (stage, mean lat, mean lng, count).
+    """
+    if not lats:
+        return []
+    lats = np.asarray(lats)
+    lngs = np.asarray(lngs)
+    stage_names, stage_idx = np.unique(np.asarray(stages, dtype=object), return_inverse=True)
+    lat0, lng0 = lats.min(), lngs.min()
+    span = max(lats.max() - lat0, lngs.max() - lng0) or 1.0
+
+    def occupied(cells):
+        row = np.minimum(((lats - lat0) / span * cells).astype(np.int64), cells - 1)
+        col = np.minimum(((lngs - lng0) / span * cells).astype(np.int64), cells - 1)
+        return np.unique((stage_idx * cells + row) * cells + col, return_inverse=True)
+
+    cells = 1
+    keys, inverse = occupied(cells)
+    while cells < GRID_MAX_CELLS:
+        finer_cells = math.ceil(cells * 1.5)
+        finer = occupied(finer_cells)
+        if len(finer[0]) > max_bins:
+            break
+        cells = finer_cells
+        keys, inverse = finer
+
+    counts = np.bincount(inverse)
+    mean_lat = np.bincount(inverse, weights=lats) / counts
+    mean_lng = np.bincount(inverse, weights=lngs) / counts
+    bin_stage = stage_names[keys // (cells * cells)]
+    return list(zip(bin_stage, mean_lat.tolist(), mean_lng.tolist(), counts.tolist()))
+
+
+def render_mode(n_points, requested="grid"):
+    """Pick how to draw ``n_points``: "markers", "cluster" or "grid".
+
+    Small sets are drawn as individual markers. Larger ones use the
+    requested mode, with clustering falling back to grid bins above
+    CLUSTER_MAX_POINTS so the page size stays bounded.
+    """
+    if n_points <= MARKER_LIMIT:
+        return "markers"
+    if requested == "cluster" and n_points <= CLUSTER_MAX_POINTS:
+        return "cluster"
+    return "grid"
+
+
+def add_occurrences(fmap, groups, colors, requested="grid"):
+    """Draw the occurrences of every stage×unit group on ``fmap``, colored by stage.
+
+    Returns (mode used, number of points, number of map objects drawn).
+    """
+    lats, lngs, stages, names = _points(groups)
+    mode = render_mode(len(lats), requested)
+
+    if mode == "markers":
+        for lat, lng, stage, name in zip(lats, lngs, stages, names):
+            folium.CircleMarker(
+                location=[lat, lng],
+                radius=4,
+                color=colors[stage],
+                fill=True,
+                fill_opacity=0.7,
+                popup=f"{name}<br>{stage}",
+            ).add_to(fmap)
+        return mode, len(lats), len(lats)
+
+    if mode == "cluster":
+        rows = [[round(lat, 5), round(lng, 5), colors[stage], f"{name}<br>{stage}"]
+                for lat, lng, stage, name in zip(lats, lngs, stages, names)]
+        FastMarkerCluster(rows, callback=_CLUSTER_CALLBACK, name="Occurrences").add_to(fmap)
+        return mode, len(lats), len(rows)
+
+    bins = grid_bins(lats, lngs, stages)
+    for stage, lat, lng, count in bins:
+        folium.CircleMarker(
+            location=[round(lat, 5), round(lng, 5)],
+            radius=3 + 2 * math.log2(count),
+            color=colors[stage],
+            fill=True,
+            fill_opacity=0.7,
+            weight=1,
+            tooltip=f"{stage}: {count} occurrence{'s' if count > 1 else ''}",
+        ).add_to(fmap)
+    return mode, len(lats), len(bins)
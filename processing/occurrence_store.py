@@ -0,0 +1,135 @@
+import sys
+from array import array
+
+from processing.geojson_export import PROPERTIES
+
+# Everything export, correlation and the app read from an occurrence:
+# PROPERTIES already holds the interval, age and formation fields
+STORE_FIELDS = tuple(PROPERTIES) + ("lat", "lng")
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+# Marks a key the original record did not have, so .get() falls back to its default
+_MISSING = object()
+
+
+def _compact_column(values):
+    """Pack one column: floats and ints into typed arrays, anything else into a
+    list with repeated strings shared."""
+    kinds = {type(v) for v in values}
+    if kinds == {float}:
+        return array("d", values)
+    if kinds == {int} and all(INT64_MIN <= v <= INT64_MAX for v in values):
+        return array("q", values)
+    return [sys.intern(v) if type(v) is str else v for v in values]
+
+
+class OccurrenceRecord:
+    """Read-only view of one occurrence in an OccurrenceStore.
+
+    Supports the dict methods the pipeline uses (get, [], in), so records can
+    be passed wherever PBDB occurrence dicts were.
+    """
+
+    __slots__ = ("_store", "index")
+
+    def __init__(self, store, index):
+        self._store = store
+        self.index = index
+
+    def get(self, key, default=None):
+        column = self._store.columns.get(key)
+        if column is None:
+            return default
+        value = column[self.index]
+        return default if value is _MISSING else value
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def to_dict(self):
+        return {key: self[key] for key in self._store.columns if key in self}
+
+    def __repr__(self):
+        return f"OccurrenceRecord({self.to_dict()!r})"
+
+
+class OccurrenceStore:
+    """Compact, column-oriented store of PBDB occurrences.
+
+    Only ``fields`` (STORE_FIELDS by default) are kept. Numeric columns are
+    packed into typed arrays and repeated strings (intervals, formations,
+    names) are interned, so a record costs a small fraction of the PBDB dict
+    it came from. Iterating yields OccurrenceRecord views.
+    """
+
+    def __init__(self, occurrences, fields=STORE_FIELDS):
+        occurrences = list(occurrences)
+        self.columns = {
+            key: _compact_column([occ.get(key, _MISSING) for occ in occurrences])
+            for key in fields
+        }
+        self._length = len(occurrences)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if not -self._length <= index < self._length:
+            raise IndexError(index)
+        return OccurrenceRecord(self, index % self._length)
+
+    def __iter__(self):
+        return (OccurrenceRecord(self, i) for i in range(self._length))
+
+    def group(self, records):
+        """Return an OccurrenceGroup of ``records`` (records of this store)."""
+        return OccurrenceGroup(self, array("I", (record.index for record in records)))
+
+    def nbytes(self):
+        """Approximate memory held by the columns, counting each distinct object once."""
+        seen = set()
+        total = 0
+        for column in self.columns.values():
+            total += sys.getsizeof(column)
+            if isinstance(column, list):
+                for value in column:
+                    if id(value) not in seen:
+                        seen.add(id(value))
+                        total += sys.getsizeof(value)
+        return total
+
+
+class OccurrenceGroup:
+    """The occurrences of one stage×unit group, as an index array into a store.
+
+    Behaves like a read-only list of OccurrenceRecord.
+    """
+
+    __slots__ = ("store", "indices")
+
+    def __init__(self, store, indices):
+        self.store = store
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        return OccurrenceRecord(self.store, self.indices[i])
+
+    def __iter__(self):
+        store = self.store
+        return (OccurrenceRecord(store, i) for i in self.indices)
+
+
+def compact_groups(store, groups):
+    """Replace each group's list of store records with an OccurrenceGroup."""
+    return {key: store.group(records) for key, records in groups.items()}
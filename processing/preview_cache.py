@@ -0,0 +1,178 @@
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import shapely
+from shapely.geometry import mapping
+
+from processing.geojson_export import parse_polygon
+
+PREVIEW_CACHE_MAX_COORDS = 2_000_000
+# Polygon files with more coordinates than this get a simplified preview copy
+PREVIEW_SIMPLIFY_COORDS = 200_000
+# Simplification tolerance as a fraction of the file's larger bbox side
+PREVIEW_TOLERANCE = 1 / 2000
+# Properties the preview map styles and popups use
+PREVIEW_FIELDS = ("accepted_name", "stage", "unit_name", "strat_name", "lith",
+                  "best_int_name", "color")
+
+
+def load_preview(path, simplify_coords=PREVIEW_SIMPLIFY_COORDS):
+    """Parse a GeoJSON file into a preview layer.
+
+    Returns a dict with the FeatureCollection to draw as a JSON string
+    (properties reduced to PREVIEW_FIELDS), its bounds (minlng, minlat, maxlng, maxlat) and center
+    [lat, lng] (None when there are no geometries), the feature and
+    coordinate counts, the number of features skipped because their
+    geometry could not be parsed, and whether the geometries were simplified.
+    """
+    with open(path, "rb") as f:
+        source = json.load(f)
+    features, parsed = [], []
+    skipped = 0
+    for feat in source.get("features", []):
+        try:
+            geom = parse_polygon(feat["geometry"]) if feat.get("geometry") else None
+        except Exception:
+            skipped += 1
+            continue
+        features.append(feat)
+        parsed.append(geom)
+    geoms = np.empty(len(parsed), dtype=object)
+    geoms[:] = parsed
+    coords = int(shapely.get_num_coordinates(geoms).sum()) if len(geoms) else 0
+
+    bounds = center = None
+    if len(geoms) and not shapely.is_missing(geoms).all():
+        bounds = tuple(float(v) for v in shapely.total_bounds(geoms))
+        center = [(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2]
+
+    simplified = coords > simplify_coords and bounds is not None
+    if simplified:
+        tolerance = max(bounds[2] - bounds[0], bounds[3] - bounds[1]) * PREVIEW_TOLERANCE
+        geoms = shapely.simplify(geoms, tolerance, preserve_topology=True)
+        coords = int(shapely.get_num_coordinates(geoms).sum())
+
+    preview_features = []
+    for feat, geom in zip(features, geoms):
+        props = feat.get("properties") or {}
+        preview_features.append({
+            "type": "Feature",
+            "properties": {key: props[key] for key in PREVIEW_FIELDS if key in props},
+            "geometry": mapping(geom) if simplified and geom is not None else feat.get("geometry"),
+        })
+    return {
+        "data": json.dumps({"type": "FeatureCollection", "features": preview_features}),
+        "bounds": bounds,
+        "center": center,
+        "features": len(preview_features),
+        "coords": coords,
+        "skipped": skipped,
+        "simplified": simplified,
+    }
+
+
+class PreviewCache:
+    """Parsed preview layers keyed by file path and validated by mtime and size.
+
+    A file is parsed again only when its modification time or size changes.
+    Layers are evicted least-recently-used once they hold more than
+    ``max_coords`` coordinates in total. Safe to share between threads;
+    cached layers are shared and must not be mutated. Their data is kept as
+    a JSON string because folium.GeoJson adds ids to the features it is
+    given, and a string is parsed into a fresh copy for every map.
+    """
+
+    def __init__(self, max_coords=PREVIEW_CACHE_MAX_COORDS,
+                 simplify_coords=PREVIEW_SIMPLIFY_COORDS):
+        self.max_coords = max_coords
+        self.simplify_coords = simplify_coords
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._coords = 0
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return the preview layer for ``path``, or None if the file does not exist."""
+        path = Path(path)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        key = str(path.resolve())
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        layer = load_preview(path, self.simplify_coords)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._coords -= old[1]["coords"]
+            self._entries[key] = (version, layer)
+            self._coords += layer["coords"]
+            while len(self._entries) > 1 and self._coords > self.max_coords:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._coords -= evicted["coords"]
+        return layer
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._coords = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries), "coords": self._coords}
+
+
+_preview_cache = None
+_preview_cache_lock = threading.Lock()
+_listing = {}
+_listing_lock = threading.Lock()
+
+
+def get_preview_cache():
+    """Return the process-wide preview cache, creating it on first use."""
+    global _preview_cache
+    if _preview_cache is None:
+        with _preview_cache_lock:
+            if _preview_cache is None:
+                _preview_cache = PreviewCache()
+    return _preview_cache
+
+
+def preview_files(output_dir):
+    """List the GeoJSON files the preview offers, caching until the directory changes.
+
+    Point files and other GeoJSON are listed; polygon files only when they
+    have no matching points file (they are shown with it instead).
+    """
+    output_dir = Path(output_dir)
+    try:
+        version = output_dir.stat().st_mtime_ns
+    except FileNotFoundError:
+        return []
+    key = str(output_dir.resolve())
+    with _listing_lock:
+        cached = _listing.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+    files = sorted(output_dir.glob("*.geojson"))
+    names = {f.name for f in files}
+    options = [f for f in files
+               if not f.stem.endswith("_polygons")
+               or f"{f.stem[:-len('_polygons')]}_points.geojson" not in names]
+    with _listing_lock:
+        _listing[key] = (version, options)
+    return options
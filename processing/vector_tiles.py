@@ -0,0 +1,263 @@
+import gzip
+import hashlib
+import itertools
+import json
+import shutil
+import sqlite3
+import struct
+import tempfile
+from pathlib import Path
+
+import geopandas as gpd
+import pandas as pd
+
+from processing.geojson_export import PROPERTIES, point_frame, polygon_frame
+from processing.geojson_stream import iter_point_features
+
+VT_MINZOOM = 0
+VT_MAXZOOM = 10
+# Polygon simplification in tile units (4096 per tile) below and at the max zoom
+VT_SIMPLIFICATION = 2.0
+VT_SIMPLIFICATION_MAX_ZOOM = 0.5
+# Layers in drawing order: formation polygons under occurrence points
+POLYGONS_LAYER = "formations"
+POINTS_LAYER = "occurrences"
+
+PMTILES_HEADER_BYTES = 127
+PMTILES_ROOT_MAX_BYTES = 16384 - PMTILES_HEADER_BYTES
+PMTILES_LEAF_SIZE = 4096
+PMTILES_GZIP = 2
+PMTILES_MVT = 1
+
+
+def _layer_frames(groups, polygon_groups, bbox):
+    """Return {layer name: GeoDataFrame} for every non-empty layer, in drawing order."""
+    frames = {}
+    if polygon_groups:
+        parts = [polygon_frame(feats, stage, unit_name, bbox)
+                 for (stage, unit_name), feats in polygon_groups.items() if feats]
+        parts = [gdf for gdf in parts if gdf is not None]
+        if parts:
+            frames[POLYGONS_LAYER] = gpd.GeoDataFrame(
+                pd.concat(parts, ignore_index=True), crs="EPSG:4326")
+    if groups:
+        points = point_frame(itertools.chain.from_iterable(
+            iter_point_features(occs, stage, unit_name, PROPERTIES)
+            for (stage, unit_name), occs in groups.items()))
+        if points is not None:
+            frames[POINTS_LAYER] = points
+    return frames
+
+
+def _write_layer(gdf, path, layer, minzoom, maxzoom):
+    # GDAL's MVT writer simplifies per zoom in tile units and thins tiles
+    # that exceed its size limit, so low zooms stay small
+    gdf.to_file(str(path), driver="MBTiles", layer=layer,
+                dataset_options={"MINZOOM": minzoom, "MAXZOOM": maxzoom,
+                                 "SIMPLIFICATION": VT_SIMPLIFICATION,
+                                 "SIMPLIFICATION_MAX_ZOOM": VT_SIMPLIFICATION_MAX_ZOOM})
+
+
+def _merge_metadata(conns, name):
+    """Combine the metadata tables of single-layer MBTiles into one dict."""
+    merged = {}
+    layers, tilestats = [], []
+    bounds = None
+    for conn in conns:
+        meta = dict(conn.execute("SELECT name, value FROM metadata"))
+        info = json.loads(meta.pop("json", "{}"))
+        layers.extend(info.get("vector_layers", []))
+        tilestats.extend(info.get("tilestats", {}).get("layers", []))
+        box = [float(v) for v in meta["bounds"].split(",")]
+        bounds = box if bounds is None else [min(bounds[0], box[0]), min(bounds[1], box[1]),
+                                             max(bounds[2], box[2]), max(bounds[3], box[3])]
+        merged.update(meta)
+    merged["name"] = name
+    merged["bounds"] = ",".join(f"{v:.7f}" for v in bounds)
+    merged["center"] = (f"{(bounds[0] + bounds[2]) / 2:.7f},{(bounds[1] + bounds[3]) / 2:.7f},"
+                        f"{merged['minzoom']}")
+    merged["json"] = json.dumps({
+        "vector_layers": layers,
+        "tilestats": {"layerCount": len(tilestats), "layers": tilestats},
+    })
+    return merged
+
+
+def _merge_layers(layer_paths, out_path, name):
+    """Merge single-layer MBTiles into one multi-layer MBTiles at ``out_path``.
+
+    An MVT tile is a protobuf message of repeated layers, so the tiles of
+    several layers combine by concatenating their decompressed bytes.
+    """
+    shutil.copyfile(layer_paths[0], out_path)
+    conn = sqlite3.connect(out_path)
+    others = [sqlite3.connect(path) for path in layer_paths[1:]]
+    try:
+        for other in others:
+            for z, x, y, data in other.execute(
+                    "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"):
+                row = conn.execute(
+                    "SELECT tile_data FROM tiles "
+                    "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                    (z, x, y)).fetchone()
+                if row is not None:
+                    data = gzip.compress(gzip.decompress(row[0]) + gzip.decompress(data),
+                                         compresslevel=6)
+                conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (z, x, y, data))
+        metadata = _merge_metadata([conn, *others], name)
+        conn.execute("DELETE FROM metadata")
+        conn.executemany("INSERT INTO metadata VALUES (?, ?)", metadata.items())
+        conn.commit()
+    finally:
+        for other in others:
+            other.close()
+        conn.close()
+
+
+def _tile_id(z, x, y):
+    """PMTiles tile id: tiles of lower zooms first, then Hilbert order within the zoom."""
+    tile_id = ((1 << (2 * z)) - 1) // 3
+    s = 1 << z >> 1
+    while s:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+        s >>= 1
+    return tile_id
+
+
+def _varints(values, out):
+    for n in values:
+        while n > 0x7F:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+
+
+def _serialize_directory(entries):
+    """Encode (tile_id, offset, length, run_length) entries as a gzipped PMTiles directory."""
+    out = bytearray()
+    _varints([len(entries)], out)
+    _varints((e[0] - (entries[i - 1][0] if i else 0) for i, e in enumerate(entries)), out)
+    _varints((e[3] for e in entries), out)
+    _varints((e[2] for e in entries), out)
+    _varints((0 if i and e[1] == entries[i - 1][1] + entries[i - 1][2] else e[1] + 1
+              for i, e in enumerate(entries)), out)
+    return gzip.compress(bytes(out))
+
+
+def _build_directories(entries):
+    """Return (root directory, leaf directories), splitting into leaves if the root is too big."""
+    root = _serialize_directory(entries)
+    if len(root) <= PMTILES_ROOT_MAX_BYTES:
+        return root, b""
+    leaf_size = PMTILES_LEAF_SIZE
+    while True:
+        root_entries, leaves = [], bytearray()
+        for i in range(0, len(entries), leaf_size):
+            leaf = _serialize_directory(entries[i:i + leaf_size])
+            root_entries.append((entries[i][0], len(leaves), len(leaf), 0))
+            leaves += leaf
+        root = _serialize_directory(root_entries)
+        if len(root) <= PMTILES_ROOT_MAX_BYTES:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+def _write_pmtiles(mbtiles_path, out_path):
+    """Convert an MBTiles file of gzipped MVT tiles to a PMTiles v3 archive.
+
+    Identical tiles (common inside large polygons) are stored once, and runs
+    of them share one directory entry.
+    """
+    conn = sqlite3.connect(mbtiles_path)
+    try:
+        meta = dict(conn.execute("SELECT name, value FROM metadata"))
+        keys = sorted((_tile_id(z, x, (1 << z) - 1 - row), z, x, row) for z, x, row in conn.execute(
+            "SELECT zoom_level, tile_column, tile_row FROM tiles"))
+        entries, contents = [], {}
+        with tempfile.TemporaryFile() as data_file:
+            for tile_id, z, x, row in keys:
+                data = conn.execute(
+                    "SELECT tile_data FROM tiles "
+                    "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                    (z, x, row)).fetchone()[0]
+                digest = hashlib.sha256(data).digest()
+                if digest in contents:
+                    offset, length = contents[digest]
+                    last = entries[-1]
+                    if last[1] == offset and last[0] + last[3] == tile_id:
+                        last[3] += 1
+                        continue
+                else:
+                    offset, length = data_file.tell(), len(data)
+                    contents[digest] = (offset, length)
+                    data_file.write(data)
+                entries.append([tile_id, offset, length, 1])
+            data_length = data_file.tell()
+
+            root, leaves = _build_directories(entries)
+            info = json.loads(meta.get("json", "{}"))
+            info.update((k, meta[k]) for k in ("name", "description", "version", "type")
+                        if k in meta)
+            metadata = gzip.compress(json.dumps(info).encode("utf-8"))
+            minlon, minlat, maxlon, maxlat = (float(v) for v in meta["bounds"].split(","))
+            minzoom, maxzoom = int(meta["minzoom"]), int(meta["maxzoom"])
+
+            metadata_offset = PMTILES_HEADER_BYTES + len(root)
+            leaves_offset = metadata_offset + len(metadata)
+            data_offset = leaves_offset + len(leaves)
+            header = struct.pack(
+                "<7sB11Q6B4iB2i", b"PMTiles", 3,
+                PMTILES_HEADER_BYTES, len(root), metadata_offset, len(metadata),
+                leaves_offset, len(leaves), data_offset, data_length,
+                sum(e[3] for e in entries), len(entries), len(contents),
+                1, PMTILES_GZIP, PMTILES_GZIP, PMTILES_MVT, minzoom, maxzoom,
+                round(minlon * 1e7), round(minlat * 1e7), round(maxlon * 1e7), round(maxlat * 1e7),
+                minzoom, round((minlon + maxlon) / 2 * 1e7), round((minlat + maxlat) / 2 * 1e7))
+            with open(out_path, "wb") as fp:
+                fp.write(header + root + metadata + leaves)
+                data_file.seek(0)
+                shutil.copyfileobj(data_file, fp)
+    finally:
+        conn.close()
+
+
+def export_vector_tiles(groups=None, polygon_groups=None, bbox=None,
+                        output_path="output/geojsonify.mbtiles",
+                        minzoom=VT_MINZOOM, maxzoom=VT_MAXZOOM):
+    """Tile all stage×unit point and polygon groups into one MBTiles or PMTiles archive.
+
+    groups: {(stage, unit_name): occurrences}, written to the "occurrences"
+    layer. polygon_groups: {(stage, unit_name): Macrostrat map features},
+    clipped to ``bbox`` and written to the "formations" layer. Features keep
+    the same properties as the GeoJSON export, including stage and unit_name.
+    The archive type follows the suffix of ``output_path`` (.mbtiles or
+    .pmtiles); either can be opened locally or served as static files.
+    Returns the output Path, or None if there is nothing to tile.
+    """
+    output_path = Path(output_path)
+    if output_path.suffix not in (".mbtiles", ".pmtiles"):
+        raise ValueError(f"Unknown vector tile archive type: {output_path.suffix!r}")
+    frames = _layer_frames(groups, polygon_groups, bbox)
+    if not frames:
+        return None
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        layer_paths = []
+        for layer, gdf in frames.items():
+            path = Path(tmp) / f"{layer}.mbtiles"
+            _write_layer(gdf, path, layer, minzoom, maxzoom)
+            layer_paths.append(path)
+        if output_path.suffix == ".mbtiles":
+            _merge_layers(layer_paths, output_path, output_path.stem)
+        else:
+            merged = Path(tmp) / "merged.mbtiles"
+            _merge_layers(layer_paths, merged, output_path.stem)
+            _write_pmtiles(merged, output_path)
+    return output_path
@@ -0,0 +1,77 @@
+import tempfile
+import threading
+import zipfile
+
+from processing.geojson_export import EXPORT_FORMATS, output_name, write_points, write_polygons
+
+ZIP_SPOOL_BYTES = 32 * 1024 * 1024
+
+
+class ExportArchive:
+    """ZIP archive of exported files built without touching output/.
+
+    The archive lives in memory and spools to an anonymous temp file once it
+    grows past ``spool_bytes``. Members are written in ``file_format`` (a key
+    of geojson_export.EXPORT_FORMATS) straight into the archive by the same
+    writers as the on-disk export, so both produce identical files; GeoJSON
+    points go through the stream writer and are never held in memory whole.
+    After close(), members can be read back one at a time for individual
+    downloads.
+    """
+
+    def __init__(self, spool_bytes=ZIP_SPOOL_BYTES, file_format="geojson"):
+        if file_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {file_format!r}")
+        self.file_format = file_format
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        self._zip = zipfile.ZipFile(self._file, "w", zipfile.ZIP_DEFLATED)
+        self._lock = threading.Lock()
+        self.names = []
+
+    def _member(self, name):
+        return lambda: self._zip.open(name, "w")
+
+    def add_points(self, occurrences, stage, unit_name):
+        """Write a group's points into the archive. Returns the member name, or None."""
+        name = output_name(stage, unit_name, "points", self.file_format)
+        backend = "stream" if self.file_format == "geojson" else "geopandas"
+        if not write_points(occurrences, stage, unit_name, self._member(name), self.file_format,
+                            backend):
+            return None
+        self.names.append(name)
+        return name
+
+    def add_polygons(self, polygon_features, stage, unit_name, bbox, tolerance=None,
+                     precision=None, stats=None):
+        """Write a group's clipped polygons into the archive. Returns the member name, or None.
+
+        tolerance, precision and stats work as in export_polygon_geojson.
+        """
+        name = output_name(stage, unit_name, "polygons", self.file_format)
+        if not write_polygons(polygon_features, stage, unit_name, bbox, self._member(name),
+                              tolerance, precision, stats, self.file_format):
+            return None
+        self.names.append(name)
+        return name
+
+    def add_file(self, path):
+        """Add an already-exported file from disk under its file name."""
+        self._zip.write(path, path.name)
+        self.names.append(path.name)
+        return path.name
+
+    def close(self):
+        self._zip.close()
+
+    def read(self, name):
+        """Return one member's bytes, decompressed from the archive on demand."""
+        with self._lock:
+            self._file.seek(0)
+            with zipfile.ZipFile(self._file) as zf:
+                return zf.read(name)
+
+    def getvalue(self):
+        """Return the whole ZIP archive as bytes."""
+        with self._lock:
+            self._file.seek(0)
+            return self._file.read()